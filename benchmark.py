@@ -0,0 +1,268 @@
+"""
+Benchmarks for the local parts of the job path, on synthetic Nordic EPUBs.
+
+The books are generated from the reference files in xslt/incoming-nordic/reference-files:
+every content document is a copy of nordic.xhtml, and every image is a copy of demobilde.jpg.
+Each benchmark runs in its own process, so that the peak RSS belongs to that benchmark only.
+
+Example:
+
+    python benchmark.py --documents 10 100 --images 10 200 --iterations 3 --output baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import statistics
+import zipfile
+import contextlib
+import multiprocessing
+from types import SimpleNamespace
+
+from lxml import etree as ElementTree
+
+REPOSITORY_DIR = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault("XSLT", os.path.join(REPOSITORY_DIR, "xslt"))
+REFERENCE_FILES_DIR = os.path.join(
+    os.environ["XSLT"], "incoming-nordic", "reference-files")
+
+logging.basicConfig(
+    level=logging.WARNING,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stderr)]
+)
+logger = logging.getLogger(__name__)
+
+XHTML_NS = "http://www.w3.org/1999/xhtml"
+
+
+def generate_nordic_epub(path, identifier="123456", documents=10, images=10, repeat=1, guidelines="2015-1"):
+    """
+    Write a synthetic Nordic EPUB with the given number of content documents and images.
+    The body of the template is repeated `repeat` times in each document, to make bigger documents.
+    The images are spread over the documents, and all of them are declared in the OPF.
+    """
+    template = ElementTree.parse(os.path.join(
+        REFERENCE_FILES_DIR, "nordic.xhtml")).getroot()
+    with open(os.path.join(REFERENCE_FILES_DIR, "demobilde.jpg"), "rb") as f:
+        image_data = f.read()
+
+    image_hrefs = ["images/{}-{:04}.jpg".format(identifier, i + 1)
+                   for i in range(images)]
+    document_hrefs = ["{}-{:04}-chapter.xhtml".format(identifier, i + 1)
+                      for i in range(documents)]
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("mimetype", "application/epub+zip",
+                         compress_type=zipfile.ZIP_STORED)
+        archive.writestr("META-INF/container.xml",
+                         '<?xml version="1.0" encoding="UTF-8"?>'
+                         '<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">'
+                         '<rootfiles><rootfile full-path="EPUB/package.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+                         '</container>')
+
+        for number, href in enumerate(document_hrefs):
+            document = ElementTree.fromstring(ElementTree.tostring(template))
+            for meta in document.iter("{%s}meta" % XHTML_NS):
+                if meta.get("name") == "dc:identifier":
+                    meta.set("content", identifier)
+            body = document.find("{%s}body" % XHTML_NS)
+            sections = list(body)
+            for _ in range(repeat - 1):
+                for section in sections:
+                    body.append(ElementTree.fromstring(
+                        ElementTree.tostring(section)))
+            document_images = image_hrefs[number::documents]
+            img_elements = list(document.iter("{%s}img" % XHTML_NS))
+            for i, img in enumerate(img_elements):
+                if document_images:
+                    img.set("src", document_images[i % len(document_images)])
+                else:
+                    img.getparent().remove(img)
+            for extra_image in document_images[len(img_elements):]:
+                ElementTree.SubElement(
+                    body, "{%s}img" % XHTML_NS, src=extra_image, alt="")
+            archive.writestr("EPUB/" + href, ElementTree.tostring(
+                document, xml_declaration=True, encoding="UTF-8"))
+
+        archive.writestr("EPUB/nav.xhtml",
+                         '<?xml version="1.0" encoding="UTF-8"?>'
+                         '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+                         '<head><title>Innhold</title></head><body><nav epub:type="toc"><ol>'
+                         + "".join('<li><a href="{0}">{0}</a></li>'.format(href) for href in document_hrefs)
+                         + '</ol></nav></body></html>')
+
+        for href in image_hrefs:
+            archive.writestr("EPUB/" + href, image_data)
+
+        manifest = '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+        manifest += "".join('<item id="document-{}" href="{}" media-type="application/xhtml+xml"/>'.format(i, href)
+                            for i, href in enumerate(document_hrefs))
+        manifest += "".join('<item id="image-{}" href="{}" media-type="image/jpeg"/>'.format(i, href)
+                            for i, href in enumerate(image_hrefs))
+        spine = "".join('<itemref idref="document-{}"/>'.format(i)
+                        for i in range(documents))
+        archive.writestr("EPUB/package.opf",
+                         '<?xml version="1.0" encoding="UTF-8"?>'
+                         '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="pub-identifier"'
+                         ' prefix="nordic: http://www.mtm.se/epub/">'
+                         '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                         '<dc:identifier id="pub-identifier">{0}</dc:identifier>'
+                         '<dc:title>Syntetisk bok {0}</dc:title>'
+                         '<dc:language>no</dc:language>'
+                         '<meta property="nordic:guidelines">{1}</meta>'
+                         '<meta property="nordic:supplier">benchmark</meta>'
+                         '</metadata><manifest>{2}</manifest><spine>{3}</spine></package>'.format(
+                             identifier, guidelines, manifest, spine))
+    return path
+
+
+def benchmark_create_epub_no_img(epub_path, work_dir):
+    from incoming_nordic import create_epub_no_img
+    result = create_epub_no_img(epub_path, work_dir)
+    if result.get("status") != "ok":
+        raise RuntimeError("create_epub_no_img failed: " + str(result))
+
+
+def benchmark_as_dir(epub_path, work_dir):
+    from epub import Epub
+    Epub(logger, epub_path).asDir()
+
+
+def benchmark_as_file(epub_path, work_dir):
+    from epub import Epub
+    # prepare() has unzipped the book into work_dir/book
+    Epub(logger, os.path.join(work_dir, "book")).asFile()
+
+
+def benchmark_get_nordic_guidelines_version(epub_path, work_dir):
+    from nordic_to_nlbpub import get_nordic_guidelines_version
+    if not get_nordic_guidelines_version(epub_path):
+        raise RuntimeError("get_nordic_guidelines_version failed")
+
+
+def benchmark_prepare_final_output(epub_path, work_dir):
+    from main import prepare_final_output
+    dir_output = os.path.join(work_dir, "output")
+    os.makedirs(dir_output, exist_ok=True)
+    # the book stands in for the result zip of a remote job
+    result_zip_path = os.path.join(dir_output, "result.zip")
+    shutil.copy(epub_path, result_zip_path)
+    job = SimpleNamespace(dir_output=dir_output, job_id="benchmark",
+                          get_log=lambda: "benchmark\n")
+    prepare_final_output(job, "SUCCESS", result_zip_path)
+
+
+BENCHMARKS = {
+    "create_epub_no_img": benchmark_create_epub_no_img,
+    "Epub.asDir": benchmark_as_dir,
+    "Epub.asFile": benchmark_as_file,
+    "get_nordic_guidelines_version": benchmark_get_nordic_guidelines_version,
+    "prepare_final_output": benchmark_prepare_final_output,
+}
+
+
+def prepare(name, epub_path, work_dir):
+    """Set up what a benchmark needs, outside of the timed part."""
+    if name == "Epub.asFile":
+        with zipfile.ZipFile(epub_path) as archive:
+            archive.extractall(os.path.join(work_dir, "book"))
+
+
+def run_benchmark(name, epub_path, iterations):
+    """Runs in a separate process. Returns the timings and the peak RSS of the process."""
+    function = BENCHMARKS[name]
+    timings = []
+    for _ in range(iterations):
+        with tempfile.TemporaryDirectory() as work_dir:
+            prepare(name, epub_path, work_dir)
+            start = time.perf_counter()
+            # the code under test prints progress, which must not end up in the JSON on stdout
+            with contextlib.redirect_stdout(sys.stderr):
+                function(epub_path, work_dir)
+            timings.append(time.perf_counter() - start)
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        max_rss *= 1024
+    return {"timings": timings, "peak_rss_bytes": max_rss}
+
+
+def run(documents_list, images_list, repeat, iterations, benchmarks):
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with tempfile.TemporaryDirectory() as books_dir:
+        for documents in documents_list:
+            for images in images_list:
+                epub_path = generate_nordic_epub(
+                    os.path.join(books_dir, "{}x{}.epub".format(documents, images)),
+                    documents=documents, images=images, repeat=repeat)
+                size = os.path.getsize(epub_path)
+                with zipfile.ZipFile(epub_path) as archive:
+                    uncompressed_size = sum(info.file_size for info in archive.infolist())
+
+                for name in benchmarks:
+                    with context.Pool(1) as pool:
+                        measured = pool.apply(
+                            run_benchmark, (name, epub_path, iterations))
+                    median = statistics.median(measured["timings"])
+                    result = {
+                        "benchmark": name,
+                        "documents": documents,
+                        "images": images,
+                        "repeat": repeat,
+                        "epub_bytes": size,
+                        "uncompressed_bytes": uncompressed_size,
+                        "iterations": iterations,
+                        "seconds_median": median,
+                        "seconds_min": min(measured["timings"]),
+                        "seconds_max": max(measured["timings"]),
+                        "throughput_mb_per_s": size / median / 1000000 if median else None,
+                        "peak_rss_bytes": measured["peak_rss_bytes"],
+                    }
+                    results.append(result)
+                    print("{benchmark:32} {documents:5} docs {images:5} images {epub_bytes:>12} bytes "
+                          "{seconds_median:8.3f} s {throughput_mb_per_s:8.2f} MB/s "
+                          "{peak_rss_bytes:>12} bytes RSS".format(**result), file=sys.stderr)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the local processing of synthetic Nordic EPUBs.")
+    parser.add_argument("--documents", type=int, nargs="+", default=[10, 100],
+                        help="Number of content documents per book (one book per value)")
+    parser.add_argument("--images", type=int, nargs="+", default=[10, 100],
+                        help="Number of images per book (one book per value)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="How many times the body of the template is repeated in each document")
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--benchmark", action="append", choices=list(BENCHMARKS),
+                        help="Only run the given benchmark (can be repeated)")
+    parser.add_argument("--output", help="Write the results as JSON to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = run(args.documents, args.images, args.repeat,
+                  args.iterations, args.benchmark or list(BENCHMARKS))
+    report = {
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
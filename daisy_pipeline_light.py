@@ -22,6 +22,10 @@ from fastapi.responses import JSONResponse
 from typing import Optional
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 
+from metrics import REMOTE_UPLOAD_BYTES, REMOTE_DOWNLOAD_BYTES
+from tracing import Trace
+from engine_health import engine_monitor, remote_engines, ENGINE_TIMEOUT, ENGINE_REQUEST_TIMEOUT
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s",
@@ -46,15 +50,17 @@ class InMemoryLogHandler(logging.Handler):
 class RemoteDaisyPipelineJob:
     namespace = {"d": 'http://www.daisy.org/ns/pipeline/data'}
 
-    def __init__(self, script_id, arguments, context, versions, log_handler=None):
+    def __init__(self, script_id, arguments, context, versions, log_handler=None, dir_output=None, temp_dir=None, trace=None):
         self.script_id = script_id
         self.arguments = arguments
         self.context = context
         self.versions = versions
         self.engine = None
         self.job_id = None
-        self.dir_output = tempfile.mkdtemp()
+        self.temp_dir = temp_dir  # where the job request and context zip are written; None for the system default
+        self.dir_output = dir_output or tempfile.mkdtemp(dir=temp_dir)
         self.log_handler = log_handler
+        self.trace = trace or Trace()
 
         self.logger = logging.getLogger(__name__)
         self.local_log_handler = InMemoryLogHandler()
@@ -65,12 +71,15 @@ class RemoteDaisyPipelineJob:
     def run(self):
         self.logger.info(
             "Initializing and posting job to remote Daisy Pipeline...")
-        self._init_engines()
-        if not self._select_engine():
-            self.logger.error("No suitable engine found")
-            raise RuntimeError("No suitable remote engine found")
-
-        self._post_job()
+        with self.trace.span("engine-selection", "remote") as span:
+            self._init_engines()
+            if not self._select_engine():
+                self.logger.error("No suitable engine found")
+                raise RuntimeError("No suitable remote engine found")
+            span["args"]["engine"] = self.engine["endpoint"]
+
+        with self.trace.span("post", "remote", engine=self.engine["endpoint"], script=self.script_id):
+            self._post_job()
         logger.info(f"Job posted successfully with ID: {self.job_id}")
         return {
             "engine": self.engine,
@@ -79,34 +88,43 @@ class RemoteDaisyPipelineJob:
         }
 
     def get_status(self, job_id):
-        r = requests.get(self._url(self.engine, f"/jobs/{job_id}"))
+        try:
+            r = requests.get(self._url(self.engine, f"/jobs/{job_id}"), timeout=ENGINE_REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            engine_monitor.breaker(self.engine["endpoint"]).record_failure(e)
+            raise
+        engine_monitor.breaker(self.engine["endpoint"]).record_success()
         root = ET.XML(r.content.split(b"?>")[-1])
         return root.attrib["status"]
 
+    def delete(self, job_id):
+        """Delete the job on the engine, which stops it if it is still running."""
+        try:
+            r = requests.delete(self._url(self.engine, f"/jobs/{job_id}"), timeout=ENGINE_REQUEST_TIMEOUT)
+            r.raise_for_status()
+            logger.info(f"Deleted remote job {job_id} on {self.engine['endpoint']}")
+            return True
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Could not delete remote job {job_id}: {e}")
+            return False
+
     def download_all(self, job_id):
         self.job_id = job_id
-        return self._download_result()
+        with self.trace.span("download", "remote", engine=self.engine["endpoint"], job_id=job_id):
+            return self._download_result()
         # self._download_log()
 
     def _init_engines(self):
-        self.engines = []
-        endpoints = os.getenv("REMOTE_PIPELINE2_WS_ENDPOINTS", "").split()
-        auth = os.getenv("REMOTE_PIPELINE2_WS_AUTHENTICATION", "").split()
-        keys = os.getenv("REMOTE_PIPELINE2_WS_AUTHENTICATION_KEYS", "").split()
-        secrets = os.getenv(
-            "REMOTE_PIPELINE2_WS_AUTHENTICATION_SECRETS", "").split()
-        for i, endpoint in enumerate(endpoints):
-            self.engines.append({
-                "endpoint": endpoint,
-                "authentication": auth[i] if i < len(auth) else "false",
-                "key": keys[i] if i < len(keys) else None,
-                "secret": secrets[i] if i < len(secrets) else None
-            })
+        self.engines = remote_engines()
 
     def _select_engine(self):
         logger.info("Available engines: " + str(self.engines))
         for pipeline_version, script_version in self.versions:
             for engine in self.engines:
+                if not engine_monitor.breaker(engine["endpoint"]).is_closed():
+                    # the engine is down; only the health monitor probes it until it is back
+                    logger.info(f"Skipping endpoint {engine['endpoint']}: circuit is open")
+                    continue
 
                 logger.info(
                     f"Trying endpoint: {engine['endpoint']} looking for pipeline version {pipeline_version}, script: {script_version}")
@@ -121,12 +139,19 @@ class RemoteDaisyPipelineJob:
 
     def _script_available(self, engine, pipeline_version, script_version):
         scripts = None
+        breaker = engine_monitor.breaker(engine["endpoint"])
         try:
-            alive = requests.get(self._url(engine, "/alive"))
+            try:
+                alive = requests.get(self._url(engine, "/alive"), timeout=ENGINE_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                breaker.record_failure(e)
+                raise
             if not alive.ok:
+                breaker.record_failure(f"HTTP {alive.status_code}")
                 logger.warning(
                     f"Engine {engine['endpoint']} is not alive or not reachable.")
                 return False
+            breaker.record_success()
             version_str = ET.XML(alive.content.split(
                 b"?>")[-1]).attrib.get("version")
             if version_str != pipeline_version:
@@ -136,7 +161,7 @@ class RemoteDaisyPipelineJob:
             logger.info(
                 f"Engine {engine['endpoint']} is alive and version matches: {version_str}")
             try:
-                scripts = requests.get(self.encode_url(engine, "/scripts", {}))
+                scripts = requests.get(self.encode_url(engine, "/scripts", {}), timeout=ENGINE_TIMEOUT)
                 """root = ET.XML(scripts.content.split(b"?>")[-1])
                     engine_script = root.xpath(
                         f"/d:scripts/d:script[@id='{self.script_id}']",
@@ -149,6 +174,7 @@ class RemoteDaisyPipelineJob:
                     scripts = None
             except Exception as e:
                 scripts = None
+                breaker.record_failure(e)
                 logger.warning(
                     f"Failed to fetch scripts from {engine['endpoint']}: {e}")
                 return False
@@ -176,7 +202,7 @@ class RemoteDaisyPipelineJob:
     def _post_job(self):
         logger.info("Posting job to remote Daisy Pipeline...")
         script_url = self._url(self.engine, f"/scripts/{self.script_id}")
-        script_xml = ET.XML(requests.get(script_url).content.split(b"?>")[-1])
+        script_xml = ET.XML(requests.get(script_url, timeout=ENGINE_TIMEOUT).content.split(b"?>")[-1])
 
         job_req = ET.XML(
             "<jobRequest xmlns='http://www.daisy.org/ns/pipeline/data'/>")
@@ -218,7 +244,10 @@ class RemoteDaisyPipelineJob:
                 option_xml += "</option>"
                 job_req.append(ET.XML(option_xml))
 
-        job_xml_path = tempfile.mktemp(suffix=".xml")
+        job_xml_fd, job_xml_path = tempfile.mkstemp(
+            suffix=".xml", dir=self.temp_dir)
+        os.close(job_xml_fd)
+        temp_files = [job_xml_path]
         ET.ElementTree(job_req).write(
             job_xml_path, encoding="UTF-8", xml_declaration=True, pretty_print=True)
         multipart_fields = {
@@ -229,7 +258,9 @@ class RemoteDaisyPipelineJob:
                 "Job request: " + "".join(f.readlines()))
 
         if self.context:
-            ctx_path = tempfile.mktemp(suffix=".zip")
+            ctx_fd, ctx_path = tempfile.mkstemp(suffix=".zip", dir=self.temp_dir)
+            os.close(ctx_fd)
+            temp_files.append(ctx_path)
             with zipfile.ZipFile(ctx_path, 'w') as zipf:
                 for href, path in self.context.items():
                     print(f"Adding context file: {href} -> {path}")
@@ -237,9 +268,10 @@ class RemoteDaisyPipelineJob:
             multipart_fields["job-data"] = ("context.zip",
                                             open(ctx_path, "rb"), "application/zip")
         m = MultipartEncoder(fields=multipart_fields)
+        REMOTE_UPLOAD_BYTES.inc(m.len, engine=self.engine["endpoint"])
         try:
             r = requests.post(self._url(self.engine, "/jobs"),
-                              data=m, headers={"Content-Type": m.content_type})
+                              data=m, headers={"Content-Type": m.content_type}, timeout=ENGINE_REQUEST_TIMEOUT)
             print(str(r.content, 'utf-8'))
             r.raise_for_status()
             response = str(r.content, 'utf-8')
@@ -256,14 +288,23 @@ class RemoteDaisyPipelineJob:
                 raise e
         except requests.exceptions.RequestException as e:
             logging.error("HTTP request failed: %s", e)
+            engine_monitor.breaker(self.engine["endpoint"]).record_failure(e)
             raise e
+        finally:
+            for _, file, _ in multipart_fields.values():
+                file.close()
+            for path in temp_files:
+                if os.path.exists(path):
+                    os.remove(path)
 
     def _download_result(self):
         url = self._url(self.engine, f"/jobs/{self.job_id}/result")
         result_zip = os.path.join(self.dir_output, f"{self.job_id}.zip")
-        with requests.get(url, stream=True) as r:
+        with requests.get(url, stream=True, timeout=ENGINE_REQUEST_TIMEOUT) as r:
             with open(result_zip, 'wb') as f:
                 shutil.copyfileobj(r.raw, f)
+        REMOTE_DOWNLOAD_BYTES.inc(os.path.getsize(
+            result_zip), engine=self.engine["endpoint"])
         with zipfile.ZipFile(result_zip, 'r') as z:
             z.extractall(self.dir_output)
         return result_zip
@@ -271,7 +312,7 @@ class RemoteDaisyPipelineJob:
     def get_log(self):
         url = self._url(self.engine, f"/jobs/{self.job_id}/log")
         try:
-            r = requests.get(url)
+            r = requests.get(url, timeout=ENGINE_REQUEST_TIMEOUT)
             r.raise_for_status()
             remote_log = str(r.content, 'utf-8')
         except Exception as e:
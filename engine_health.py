@@ -0,0 +1,198 @@
+import os
+import sys
+import time
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from lxml import etree as ET
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+# seconds to wait for an engine to accept a connection, and to answer a health or script lookup
+ENGINE_TIMEOUT = float(os.environ.get("ENGINE_TIMEOUT", "5"))
+# seconds to wait for an answer to the other requests, like posting a job or downloading a result
+ENGINE_READ_TIMEOUT = float(os.environ.get("ENGINE_READ_TIMEOUT", "300"))
+ENGINE_REQUEST_TIMEOUT = (ENGINE_TIMEOUT, ENGINE_READ_TIMEOUT)
+# failures in a row before the circuit of an engine opens, and how long it stays open before it is probed again
+ENGINE_FAILURE_THRESHOLD = int(os.environ.get("ENGINE_FAILURE_THRESHOLD", "2"))
+ENGINE_OPEN_SECONDS = float(os.environ.get("ENGINE_OPEN_SECONDS", "30"))
+ENGINE_HEALTH_INTERVAL = float(os.environ.get("ENGINE_HEALTH_INTERVAL", "15"))
+
+
+def remote_engines():
+    """The Pipeline 2 engines configured in REMOTE_PIPELINE2_WS_ENDPOINTS, with their authentication."""
+    endpoints = os.getenv("REMOTE_PIPELINE2_WS_ENDPOINTS", "").split()
+    auth = os.getenv("REMOTE_PIPELINE2_WS_AUTHENTICATION", "").split()
+    keys = os.getenv("REMOTE_PIPELINE2_WS_AUTHENTICATION_KEYS", "").split()
+    secrets = os.getenv(
+        "REMOTE_PIPELINE2_WS_AUTHENTICATION_SECRETS", "").split()
+    return [{
+        "endpoint": endpoint,
+        "authentication": auth[i] if i < len(auth) else "false",
+        "key": keys[i] if i < len(keys) else None,
+        "secret": secrets[i] if i < len(secrets) else None
+    } for i, endpoint in enumerate(endpoints)]
+
+
+class CircuitBreaker:
+    """
+    Keeps jobs away from an engine that is down. After `failure_threshold` failures in a row
+    the circuit opens, and jobs skip the engine without any requests: they only use engines
+    whose circuit is closed. When it has been open for `open_seconds`, the health monitor
+    gets to make one trial request (half-open) through allow(): if it succeeds the circuit
+    closes, if it fails the circuit opens again.
+    """
+
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+    def __init__(self, name, failure_threshold=ENGINE_FAILURE_THRESHOLD, open_seconds=ENGINE_OPEN_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started = None
+        self.last_error = None
+        self.lock = threading.Lock()
+
+    def is_closed(self):
+        with self.lock:
+            return self.state == self.CLOSED
+
+    def allow(self):
+        """True if the health monitor may send a request to the engine."""
+        now = time.monotonic()
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.open_seconds:
+                    return False
+                self.state = self.HALF_OPEN
+            elif now - self.trial_started < self.open_seconds:
+                # the trial request hasn't reported back yet
+                return False
+            self.trial_started = now
+            logger.info(f"Probing engine {self.name} again")
+            return True
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Engine {self.name} is available again")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.last_error = None
+
+    def record_failure(self, error):
+        with self.lock:
+            self.failures += 1
+            self.last_error = str(error)
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                logger.warning(
+                    f"Engine {self.name} is skipped for {self.open_seconds:.0f} s after {self.failures} failures: {error}")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def status(self):
+        with self.lock:
+            return {"state": self.state, "failures": self.failures, "last_error": self.last_error}
+
+
+class EngineMonitor:
+    """
+    Circuit breakers for the Pipeline 2 engines, and a background monitor that checks /alive
+    on all engines at the same time every `interval` seconds. The health endpoint reports
+    the result of the last check, so it doesn't wait for engines that are down.
+    """
+
+    def __init__(self, interval=ENGINE_HEALTH_INTERVAL, timeout=ENGINE_TIMEOUT):
+        self.interval = interval
+        self.timeout = timeout
+        self.breakers = {}
+        self.health = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=8, thread_name_prefix="engine-health")
+
+    def breaker(self, endpoint):
+        with self.lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(endpoint)
+            return self.breakers[endpoint]
+
+    def probe(self, engine):
+        """Check /alive on one engine, unless its circuit is open. Returns the last known health."""
+        endpoint = engine["endpoint"]
+        breaker = self.breaker(endpoint)
+        if not breaker.allow():
+            with self.lock:
+                return self.health.get(endpoint)
+
+        started = time.monotonic()
+        try:
+            r = requests.get(endpoint.rstrip("/") + "/alive", timeout=self.timeout)
+            r.raise_for_status()
+            version = ET.XML(r.content.split(b"?>")[-1]).attrib.get("version", "unknown")
+        except Exception as e:
+            breaker.record_failure(e)
+            health = {"endpoint": endpoint, "alive": False, "error": str(e)}
+        else:
+            breaker.record_success()
+            health = {"endpoint": endpoint, "alive": True, "version": version}
+        health["checked"] = datetime.utcnow().isoformat()
+        health["seconds"] = time.monotonic() - started
+        with self.lock:
+            self.health[endpoint] = health
+        return health
+
+    def check_all(self):
+        """Check all engines at the same time."""
+        return list(self.executor.map(self.probe, remote_engines()))
+
+    def run_monitor(self):
+        while True:
+            try:
+                self.check_all()
+            except Exception:
+                logger.exception("Checking the engines failed")
+            time.sleep(self.interval)
+
+    def status(self):
+        """The last known health and the circuit of each configured engine."""
+        engines = []
+        for engine in remote_engines():
+            endpoint = engine["endpoint"]
+            with self.lock:
+                health = dict(self.health.get(endpoint) or {
+                    "endpoint": endpoint, "alive": None, "error": "Not checked yet"})
+            health["circuit"] = self.breaker(endpoint).status()
+            engines.append(health)
+        return engines
+
+    def report(self):
+        """The health of the engines, in the format of the health endpoint."""
+        alive = []
+        unavailable = []
+        for health in self.status():
+            if health["alive"] and health["circuit"]["state"] != CircuitBreaker.OPEN:
+                alive.append({"endpoint": health["endpoint"], "version": health["version"]})
+            else:
+                unavailable.append({"endpoint": health["endpoint"],
+                                    "error": health.get("error") or health["circuit"]["last_error"]})
+        return {"alive": alive, "unavailable": unavailable}
+
+
+engine_monitor = EngineMonitor()
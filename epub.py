@@ -7,11 +7,13 @@ import re
 import stat
 import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 from lxml import etree as ElementTree
 
 from xslt import Xslt
 from filesystem import Filesystem
+from metrics import CACHE_REQUESTS
 
 
 class Epub():
@@ -19,6 +21,7 @@ class Epub():
 
     report = None
     _metadata = None
+    _package = None
     book_path = None
     book_path_file = None
     book_path_dir = None
@@ -118,115 +121,154 @@ class Epub():
                     if "mimetype" not in [item.filename for item in archive.filelist]:
                         if report_errors:
                             self.report.warn(
-                                "No 'mimetype' file in ZIP; this is not an EPUB: " + self.book_path)
+                                "No 'mimetype' file in ZIP; this is not an EPUB: " + os.path.basename(self.book_path))
                         return False
 
-                    mimetype = archive.read("mimetype").decode("utf-8")
+                    try:
+                        mimetype = archive.read("mimetype").decode("utf-8")
+                    except UnicodeDecodeError:
+                        mimetype = ""
                     if not mimetype.startswith("application/epub+zip"):
                         if report_errors:
                             self.report.warn(
-                                "The 'mimetype' file does not start with the text 'application/epub+zip'; this is not an EPUB: " + self.book_path)
+                                "The 'mimetype' file does not start with the text 'application/epub+zip'; this is not an EPUB: " + os.path.basename(self.book_path))
                         return False
 
                     if "META-INF/container.xml" not in [item.filename for item in archive.filelist]:
                         if report_errors:
                             self.report.warn(
-                                "No 'META-INF/container.xml' file in ZIP; this is not an EPUB: " + self.book_path)
+                                "No 'META-INF/container.xml' file in ZIP; this is not an EPUB: " + os.path.basename(self.book_path))
                         return False
 
             except zipfile.BadZipfile:
                 if report_errors:
                     self.report.warn(
-                        "The book is a file, but not a ZIP file. This is not an EPUB: " + self.book_path)
+                        "The book is a file, but not a ZIP file. This is not an EPUB: " + os.path.basename(self.book_path))
                 return False
 
         return True
 
-    def opf_path(self):
-        container = None
+    def package(self):
+        """
+        Parsed package document, with the manifest indexed by id and the spine resolved.
+
+        The model is cached, and is parsed again only when container.xml or the OPF
+        (or the EPUB file itself, when zipped) changes on disk, or when invalidate_package() is called.
+        The "element" is shared between callers; call invalidate_package() after modifying it.
+        """
+        if self._package is not None and self._package["signature"] == self._package_signature(self._package["opf_path"]):
+            CACHE_REQUESTS.inc(cache="epub-package", result="hit")
+            return self._package
+        CACHE_REQUESTS.inc(cache="epub-package", result="miss")
+
+        self._package = None
+        self._metadata = None
 
         if os.path.isdir(self.book_path):
             container = ElementTree.parse(os.path.join(
                 self.book_path, "META-INF/container.xml")).getroot()
+            opf_path = Epub._rootfile(container)
+            opf = ElementTree.parse(os.path.join(
+                self.book_path, opf_path)).getroot()
 
         elif os.path.isfile(self.book_path):
             with zipfile.ZipFile(self.book_path, 'r') as archive:
-                container = archive.read("META-INF/container.xml")
-                container = ElementTree.XML(container)
+                container = ElementTree.XML(
+                    archive.read("META-INF/container.xml"))
+                opf_path = Epub._rootfile(container)
+                opf = ElementTree.XML(archive.read(opf_path))
 
         else:
             return None
 
-        rootfiles = container.findall(
-            '{urn:oasis:names:tc:opendocument:xmlns:container}rootfiles')[0]
-        rootfile = rootfiles.findall(
-            '{urn:oasis:names:tc:opendocument:xmlns:container}rootfile')[0]
-        opf = rootfile.attrib["full-path"]
-        return opf
-
-    def get_opf_package_element(self):
-        opf_path = self.opf_path()
+        manifest = {}
+        nav = None
+        for item in opf.iterfind('{http://www.idpf.org/2007/opf}manifest/{http://www.idpf.org/2007/opf}item'):
+            if "id" in item.attrib:
+                manifest[item.attrib["id"]] = item
+            if nav is None and "properties" in item.attrib and "nav" in re.split(r'\s+', item.attrib["properties"]):
+                nav = os.path.join(os.path.dirname(opf_path), item.attrib["href"])
 
-        if os.path.isdir(self.book_path):
-            return ElementTree.parse(os.path.join(self.book_path, opf_path)).getroot()
+        spine = []
+        for itemref in opf.iterfind('{http://www.idpf.org/2007/opf}spine/{http://www.idpf.org/2007/opf}itemref'):
+            data = dict(itemref.attrib)
+            data.update(manifest[itemref.attrib["idref"]].attrib)
+            del data["idref"]
+            spine.append(data)
 
-        elif os.path.isfile(self.book_path):
-            with zipfile.ZipFile(self.book_path, 'r') as archive:
-                opf = archive.read(opf_path)
-                return ElementTree.XML(opf)
+        self._package = {
+            "signature": self._package_signature(opf_path),
+            "opf_path": opf_path,
+            "element": opf,
+            "manifest": manifest,
+            "spine": spine,
+            "nav_path": nav,
+        }
+        return self._package
+
+    def invalidate_package(self):
+        """Discard the cached package model, for instance after modifying the OPF"""
+        self._package = None
+        self._metadata = None
 
+    def _package_signature(self, opf_path):
+        if os.path.isdir(self.book_path):
+            paths = [os.path.join(self.book_path, "META-INF/container.xml")]
+            if opf_path:
+                paths.append(os.path.join(self.book_path, opf_path))
         else:
-            return None
+            paths = [self.book_path]
 
-    def nav_path(self):
-        opf = self.get_opf_package_element()
+        signature = []
+        for path in paths:
+            try:
+                stat_result = os.stat(path)
+                signature.append((stat_result.st_mtime_ns, stat_result.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
 
-        if opf is None:
-            return None
+    @staticmethod
+    def _rootfile(container):
+        rootfiles = container.findall(
+            '{urn:oasis:names:tc:opendocument:xmlns:container}rootfiles')[0]
+        rootfile = rootfiles.findall(
+            '{urn:oasis:names:tc:opendocument:xmlns:container}rootfile')[0]
+        return rootfile.attrib["full-path"]
 
-        manifest = opf.findall('{http://www.idpf.org/2007/opf}manifest')[0]
-        items = manifest.findall("*")
-        for item in items:
-            if "properties" in item.attrib and "nav" in re.split(r'\s+', item.attrib["properties"]):
-                return os.path.join(os.path.dirname(self.opf_path()), item.attrib["href"])
+    def opf_path(self):
+        package = self.package()
+        return package["opf_path"] if package else None
+
+    def get_opf_package_element(self):
+        package = self.package()
+        return package["element"] if package else None
 
-        return None
+    def nav_path(self):
+        package = self.package()
+        return package["nav_path"] if package else None
 
     def identifier(self, default=None):
         return self.meta("dc:identifier")
 
     def spine(self):
-        opf = self.get_opf_package_element()
+        package = self.package()
 
-        if opf is None:
+        if package is None:
             return None
 
-        ns = {"opf": "http://www.idpf.org/2007/opf"}
-        itemrefs = opf.xpath("//opf:spine/opf:itemref", namespaces=ns)
-        spine = []
-        for itemref in itemrefs:
-            item = opf.xpath(
-                "//opf:manifest/opf:item[@id = '{}']".format(itemref.attrib["idref"]), namespaces=ns)
-            data = {}
-            for a in itemref.attrib:
-                data[a] = itemref.attrib[a]
-            for a in item[0].attrib:
-                data[a] = item[0].attrib[a]
-            del data["idref"]
-            spine.append(data)
-
-        return spine
+        return [dict(itemref) for itemref in package["spine"]]
 
     def metadata(self):
         """Read OPF metadata"""
-        if not self._metadata:
-            opf = self.get_opf_package_element()
+        package = self.package()
+        if self._metadata is None:
             self._metadata = {}
 
-            if opf is None:
+            if package is None:
                 return self._metadata
 
-            opf_metadata = opf.findall(
+            opf_metadata = package["element"].findall(
                 '{http://www.idpf.org/2007/opf}metadata')[0]
             for m in opf_metadata.findall("*"):
                 if "refines" in m.attrib:
@@ -243,24 +285,37 @@ class Epub():
         return self._metadata[name] if name in self._metadata else default
 
     def refresh_metadata(self):
-        self._metadata = None
+        self.invalidate_package()
         self.metadata()
 
     # iterates over the package document and all the content documents and updates their "prefix"/"epub:prefix" attributes
-    def update_prefixes(self):
+    # in batch mode all the documents are transformed in one Saxon run and replaced together
+    def update_prefixes(self, batch=True):
+        stylesheet = os.path.join(
+            Xslt.xslt_dir, Epub.uid, "update-epub-prefixes.xsl")
+        opf_path = os.path.join(self.book_path, self.opf_path())
+
+        if batch:
+            # the prefixes in the OPF does not affect the manifest, so all documents can be transformed at once
+            html_paths = [os.path.normpath(os.path.join(os.path.dirname(opf_path), html_relpath))
+                          for html_relpath in self.get_opf_package_element().xpath(
+                "/*/*[local-name()='manifest']/*[@media-type='application/xhtml+xml']/@href")]
+            success = Xslt.transform_batch(
+                self.report, stylesheet, [opf_path] + html_paths)
+            self.invalidate_package()
+            return success
+
         temp_xml_file_obj = tempfile.NamedTemporaryFile()
         temp_xml_file = temp_xml_file_obj.name
 
-        opf_path = os.path.join(self.book_path, self.opf_path())
-
         xslt = Xslt(report=self.report,
-                    stylesheet=os.path.join(
-                        Xslt.xslt_dir, Epub.uid, "update-epub-prefixes.xsl"),
+                    stylesheet=stylesheet,
                     source=opf_path,
                     target=temp_xml_file)
         if not xslt.success:
             return False
         shutil.copy(temp_xml_file, opf_path)
+        self.invalidate_package()
 
         opf_element = self.get_opf_package_element()
         html_paths = opf_element.xpath(
@@ -270,8 +325,7 @@ class Epub():
                 os.path.dirname(opf_path), html_relpath))
 
             xslt = Xslt(report=self.report,
-                        stylesheet=os.path.join(
-                            Xslt.xslt_dir, Epub.uid, "update-epub-prefixes.xsl"),
+                        stylesheet=stylesheet,
                         source=html_path,
                         target=temp_xml_file)
             if not xslt.success:
@@ -280,6 +334,43 @@ class Epub():
 
         return True
 
+    # Detection of content document properties, matching on the start tags of the elements.
+    #   mathml: <math>, <m:math>, <math:math>
+    #   scripted: elements for scripting and forms. Could also check for onclick attributes and similar, and should
+    #             ideally ignore input elements if they have the type attribute is "image"
+    #   svg: we could also check img/@src and iframe/@src for .svg files, and object elements could also contain SVG,
+    #        but that is complex and probably very uncommon in the wild.
+    #   switch: deprecated in EPUB 3.2 but can be useful during production if we want to include for instance MusicXML
+    content_properties_pattern = re.compile(
+        rb"<(?:(math|m:math)|(script|form|button|fieldset|input|object|output|select|textarea)|(svg)|(epub:switch))")
+    content_properties_groups = {1: "mathml", 2: "scripted", 3: "svg", 4: "switch"}
+    content_sniffing_chunk_size = 1024 * 1024
+    content_sniffing_workers = 8
+
+    @staticmethod
+    def sniff_content_properties(content_path):
+        """
+        Scan a content document for the elements that require manifest properties.
+
+        The file is read once in binary chunks (so minified single-line documents
+        don't have to fit in one line), with an overlap between the chunks so that
+        matches are not lost at the chunk boundaries. The scan stops early when
+        all the properties have been found.
+        """
+        found = set()
+        overlap = len(b"<epub:switch") - 1
+        tail = b""
+        with open(content_path, "rb") as f:
+            while len(found) < len(Epub.content_properties_groups):
+                chunk = f.read(Epub.content_sniffing_chunk_size)
+                if not chunk:
+                    break
+                data = tail + chunk
+                for match in Epub.content_properties_pattern.finditer(data):
+                    found.add(Epub.content_properties_groups[match.lastindex])
+                tail = data[-overlap:]
+        return found
+
     # Iterates over the content documents in the OPF manifest and updates their property attributes.
     # Also updates the spine linear property, and adds a reference to the cover image in the metadata.
     def update_opf_properties(self):
@@ -292,9 +383,12 @@ class Epub():
 
         cover_id = None
         types = {}
+        item_properties = {}
+        content_paths = {}
 
         for item in manifest:
             properties = set()
+            item_properties[item] = properties
 
             if item.attrib.get("href", "").split("/")[-1] in ["cover.jpg", "cover.jpeg", "cover.png"]:
                 properties.add("cover-image")
@@ -310,27 +404,14 @@ class Epub():
                 epub_type = content_path.split(
                     "/")[-1].split("-")[-1].split(".")[0]
                 types[item.attrib.get("id", None)] = epub_type
+                content_paths[item] = content_path
 
-                with open(content_path) as f:
-                    for line in f:
-                        if "<math" in line or "<m:math" in line or "<math:math" in line:
-                            properties.add("mathml")
-
-                        if ("<script" in line or "<form" in line or "<button" in line or "<fieldset" in line or "<input" in line or
-                                "<object" in line or "<output" in line or "<select" in line or "<textarea" in line):
-                            properties.add("scripted")
-                            # could also check for onclick attributes and similar, and should ideally ignore
-                            # input elements if they have the type attribute is "image"
-
-                        if "<svg" in line:
-                            properties.add("svg")
-                            # we could also check img/@src and iframe/@src for .svg files but it would require XML parsing or a regex.
-                            # object elements could also contain SVG but are even more complex and probably very uncommon in the wild.
-
-                        if "<epub:switch" in line:
-                            properties.add("switch")
-                            # this is deprecated in EPUB 3.2 but can be useful during production if we want to include for instance MusicXML
+        # the content documents are independent of each other, so they are scanned in parallel
+        with ThreadPoolExecutor(max_workers=Epub.content_sniffing_workers) as executor:
+            for item, properties in zip(content_paths, executor.map(Epub.sniff_content_properties, content_paths.values())):
+                item_properties[item].update(properties)
 
+        for item, properties in item_properties.items():
             if properties:
                 properties = item.attrib.get("properties", "").split(
                 ) + list(properties)  # add any preexisting properties
@@ -361,6 +442,7 @@ class Epub():
 
         with open(opf_path, "w") as f:
             f.write(serialized)
+        self.invalidate_package()
 
         return True
 
@@ -0,0 +1,102 @@
+import os
+import heapq
+import threading
+from collections import deque
+
+
+ESTIMATE_WINDOW = int(os.environ.get("ESTIMATE_WINDOW", "50"))
+ESTIMATE_DEFAULT_STEP_SECONDS = float(
+    os.environ.get("ESTIMATE_DEFAULT_STEP_SECONDS", "120"))
+
+
+class StepDurationModel:
+    """
+    Estimates how long job steps take, from the durations of the most recent successful
+    runs of each step. Steps that haven't run yet are assumed to take the default duration.
+
+    When the EPUB sizes of the runs are known, the duration of a step for a given size is
+    fitted as a straight line (fixed cost plus seconds per byte) over the recent runs.
+    Without a size, or when the runs don't show that bigger books take longer, the mean
+    duration is used.
+    """
+
+    def __init__(self, window=ESTIMATE_WINDOW, default_seconds=ESTIMATE_DEFAULT_STEP_SECONDS):
+        self.window = window
+        self.default_seconds = default_seconds
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    def record(self, step, seconds, size=None):
+        with self.lock:
+            if step not in self.durations:
+                self.durations[step] = deque(maxlen=self.window)
+            self.durations[step].append((seconds, size))
+
+    @staticmethod
+    def _fit(durations):
+        """Least squares fit of seconds = fixed + per_byte * size. Returns None if there is no upward trend."""
+        runs = [(size, seconds) for seconds, size in durations if size is not None]
+        if len(runs) < 2:
+            return None
+        mean_size = sum(size for size, _ in runs) / len(runs)
+        mean_seconds = sum(seconds for _, seconds in runs) / len(runs)
+        variance = sum((size - mean_size) ** 2 for size, _ in runs)
+        if not variance:
+            return None
+        per_byte = sum((size - mean_size) * (seconds - mean_seconds) for size, seconds in runs) / variance
+        if per_byte <= 0:
+            return None
+        return mean_seconds - per_byte * mean_size, per_byte
+
+    def step_seconds(self, step, size=None):
+        with self.lock:
+            durations = list(self.durations.get(step) or [])
+        if not durations:
+            return self.default_seconds
+        fit = self._fit(durations) if size is not None else None
+        if fit:
+            fixed, per_byte = fit
+            return max(0.0, fixed + per_byte * size)
+        return sum(seconds for seconds, _ in durations) / len(durations)
+
+    def job_seconds(self, steps, size=None):
+        return sum(self.step_seconds(step, size) for step in steps)
+
+    def remaining_seconds(self, steps, elapsed, size=None):
+        """How much longer a job will take that has `steps` left and has been `elapsed` seconds in the first of them."""
+        if not steps:
+            return 0.0
+        return max(0.0, self.step_seconds(steps[0], size) - elapsed) + self.job_seconds(steps[1:], size)
+
+    def status(self):
+        with self.lock:
+            durations = {step: list(runs) for step, runs in self.durations.items() if runs}
+        steps = {}
+        for step, runs in durations.items():
+            steps[step] = {"runs": len(runs), "mean_seconds": sum(seconds for seconds, _ in runs) / len(runs)}
+            fit = self._fit(runs)
+            if fit:
+                steps[step]["seconds_per_mb"] = fit[1] * 1024 * 1024
+        return {"default_seconds": self.default_seconds, "steps": steps}
+
+
+def start_after(free_at, ahead, job_seconds):
+    """
+    Seconds until a job starts that has `ahead` jobs of `job_seconds` each before it, when the
+    workers are free after `free_at` seconds. Once the workers are free within one job of
+    each other they take the jobs in turn, so only the first jobs need to be handed out.
+    """
+    free_at = sorted(free_at)
+    if job_seconds <= 0:
+        return free_at[0]
+    latest = free_at[-1]
+    while ahead and latest > free_at[0] + job_seconds:
+        free = heapq.heappop(free_at) + job_seconds
+        heapq.heappush(free_at, free)
+        latest = max(latest, free)
+        ahead -= 1
+    free_at.sort()
+    return free_at[ahead % len(free_at)] + (ahead // len(free_at)) * job_seconds
+
+
+step_durations = StepDurationModel()
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import errno
 import hashlib
 import logging
 import os
 import re
 import requests
 import shutil
+import signal
 import socket
 import subprocess
 import tempfile
@@ -15,8 +17,21 @@ import traceback
 import urllib.parse
 import urllib.request
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from metrics import CACHE_REQUESTS
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+class UnsafeArchiveError(Exception):
+    """Raised when a ZIP file exceeds the extraction limits or contains unsafe paths"""
+
 
 class Filesystem():
     """Operations on files and directories"""
@@ -29,6 +44,27 @@ class Filesystem():
         "*.crdownload"
     )
 
+    # ioctl for copy-on-write clones of files (reflinks) on Btrfs, XFS and similar filesystems
+    FICLONE = 0x40049409
+
+    hash_chunk_size = 1024 * 1024
+    _hash_cache = {}
+    _hash_cache_lock = threading.Lock()
+    _hash_cache_max_size = 100000
+    _reflink_unsupported = set()  # devices where FICLONE has failed
+
+    # limits for extracting untrusted ZIP files
+    unzip_max_total_size = int(os.environ.get(
+        "UNZIP_MAX_TOTAL_SIZE", str(10 * 1024 * 1024 * 1024)))
+    unzip_max_entries = int(os.environ.get("UNZIP_MAX_ENTRIES", "50000"))
+    unzip_max_ratio = int(os.environ.get("UNZIP_MAX_RATIO", "200"))
+    unzip_parallel_threshold = 64 * 1024 * 1024
+    unzip_workers = int(os.environ.get("UNZIP_WORKERS", "4"))
+
+    # output of tools run with run_static_streaming
+    stream_read_size = 64 * 1024
+    stream_tail_lines = int(os.environ.get("SUBPROCESS_TAIL_LINES", "200"))
+
     def fix_permissions(target):
         # ensure that permissions are correct
         if os.path.isfile(target):
@@ -86,6 +122,208 @@ class Filesystem():
 
         return completedProcess
 
+    @staticmethod
+    def run_static_streaming(args,
+                             cwd,
+                             report=None,
+                             shell=False,
+                             timeout=600,
+                             check=True,
+                             stdout_level="DEBUG",
+                             stderr_level="DEBUG",
+                             tail_lines=None,
+                             line_callback=None,
+                             cancel=None):
+        """
+        Like run_static, but stdout and stderr are read while the process runs. Each line is
+        logged as soon as it is read, and only the last `tail_lines` lines of each stream are
+        kept, so memory use doesn't depend on how much the tool writes.
+
+        `line_callback(stream, line)` is called for every line ("stdout" or "stderr"), and
+        the process is stopped when the `cancel` event is set. The returned CompletedProcess
+        (or CalledProcessError) only contains the tails in stdout and stderr.
+        """
+
+        log = report if report else logging
+        log.debug("Kjører: " + (" ".join(args) if isinstance(args, list) else args))
+
+        tail_lines = tail_lines or Filesystem.stream_tail_lines
+        tails = {"stdout": deque(maxlen=tail_lines),
+                 "stderr": deque(maxlen=tail_lines)}
+
+        def forward(name, pipe, level):
+            with pipe:
+                # lines are read in bounded pieces, so a huge line without newlines can't fill the memory
+                for line in iter(lambda: pipe.readline(Filesystem.stream_read_size), b""):
+                    tails[name].append(line)
+                    text = line.decode("utf-8", errors="replace").rstrip("\r\n")
+                    if hasattr(log, "add_message"):
+                        log.add_message(level, text)
+                    else:
+                        getattr(log, level.lower())(text)
+                    if line_callback:
+                        line_callback(name, text)
+
+        # a new session, so that the tool and its child processes can be stopped together
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   shell=shell, cwd=cwd, start_new_session=True)
+        readers = [threading.Thread(target=forward, args=("stdout", process.stdout, stdout_level), daemon=True),
+                   threading.Thread(target=forward, args=("stderr", process.stderr, stderr_level), daemon=True)]
+        for reader in readers:
+            reader.start()
+
+        deadline = time.monotonic() + timeout if timeout else None
+        timed_out = False
+        cancelled = False
+        while process.poll() is None:
+            if cancel is not None and cancel.wait(0.2):
+                cancelled = True
+                break
+            if cancel is None:
+                try:
+                    process.wait(0.2)
+                except subprocess.TimeoutExpired:
+                    pass
+            if deadline and time.monotonic() > deadline:
+                timed_out = True
+                break
+        if process.poll() is None:
+            Filesystem.stop_process_group(process)
+
+        for reader in readers:
+            reader.join()
+        returncode = process.wait()
+        stdout = b"".join(tails["stdout"])
+        stderr = b"".join(tails["stderr"])
+
+        if timed_out:
+            raise subprocess.TimeoutExpired(args, timeout, output=stdout, stderr=stderr)
+
+        if check and returncode != 0 and not cancelled:
+            log.error("Kommandoen feilet med returkode {}: {}".format(
+                returncode, stderr.decode("utf-8", errors="replace").strip()))
+            return subprocess.CalledProcessError(returncode, args, output=stdout, stderr=stderr)
+
+        return subprocess.CompletedProcess(args, returncode, stdout, stderr)
+
+    @staticmethod
+    def stop_process_group(process, grace_period=10):
+        """Stop a process started in its own session, and its child processes: SIGTERM first, then SIGKILL."""
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(grace_period)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    def file_md5(path):
+        """
+        MD5 of the file contents, read in chunks. Hashes are cached by path, inode,
+        size and modification time, so unchanged files are only hashed once.
+        """
+        stat_result = os.stat(path)
+        key = (os.path.abspath(path), stat_result.st_ino,
+               stat_result.st_size, stat_result.st_mtime_ns)
+        with Filesystem._hash_cache_lock:
+            if key in Filesystem._hash_cache:
+                CACHE_REQUESTS.inc(cache="file-hash", result="hit")
+                return Filesystem._hash_cache[key]
+        CACHE_REQUESTS.inc(cache="file-hash", result="miss")
+
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(Filesystem.hash_chunk_size), b""):
+                md5.update(chunk)
+        digest = md5.hexdigest()
+
+        with Filesystem._hash_cache_lock:
+            if len(Filesystem._hash_cache) >= Filesystem._hash_cache_max_size:
+                Filesystem._hash_cache.clear()
+            Filesystem._hash_cache[key] = digest
+        return digest
+
+    @staticmethod
+    def path_md5(path, shallow=True):
+        """
+        MD5 of a file or a directory tree.
+
+        With `shallow`, only the names, sizes and modification times are hashed,
+        otherwise the file contents are hashed as well.
+        """
+        paths = []
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file in sorted(files):
+                    paths.append(os.path.join(root, file))
+        else:
+            paths.append(path)
+
+        md5 = hashlib.md5()
+        for file in paths:
+            stat_result = os.stat(file)
+            md5.update(os.path.relpath(file, path).encode("utf-8"))
+            md5.update(str(stat_result.st_size).encode("utf-8"))
+            if shallow:
+                md5.update(str(stat_result.st_mtime_ns).encode("utf-8"))
+            else:
+                md5.update(Filesystem.file_md5(file).encode("utf-8"))
+        return md5.hexdigest()
+
+    @staticmethod
+    def files_equal(a, b):
+        """
+        Compare two files. Files with different sizes differ, files with the same size
+        and modification time (or the same inode) are considered equal, and only
+        otherwise are the contents hashed.
+        """
+        stat_a = os.stat(a)
+        stat_b = os.stat(b)
+        if stat_a.st_size != stat_b.st_size:
+            return False
+        if (stat_a.st_dev, stat_a.st_ino) == (stat_b.st_dev, stat_b.st_ino):
+            return True
+        if stat_a.st_mtime_ns == stat_b.st_mtime_ns:
+            return True
+        return Filesystem.file_md5(a) == Filesystem.file_md5(b)
+
+    @staticmethod
+    def clone_file(src, dst, hardlink=False):
+        """
+        Copy a file as cheaply as the filesystem allows: as a reflink (copy-on-write clone)
+        if supported, as a hardlink if `hardlink` is set (only safe when neither of the
+        files will be modified in place), and otherwise as a normal copy.
+        Metadata is copied as with shutil.copy2. Returns `dst`, like shutil.copy2.
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+
+        device = os.stat(src).st_dev
+        if fcntl is not None and not os.path.islink(src) and device not in Filesystem._reflink_unsupported:
+            try:
+                with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+                    fcntl.ioctl(dst_file.fileno(), Filesystem.FICLONE,
+                                src_file.fileno())
+                shutil.copystat(src, dst)
+                return dst
+            except OSError as e:
+                # not supported by the filesystem, or across filesystems
+                if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                    Filesystem._reflink_unsupported.add(device)
+
+        if hardlink:
+            try:
+                if os.path.exists(dst):
+                    os.remove(dst)
+                os.link(src, dst)
+                return dst
+            except OSError:
+                pass
+
+        return shutil.copy2(src, dst)
+
     @staticmethod
     def copytree(report, src, dst):
         assert os.path.isdir(src)
@@ -101,7 +339,8 @@ class Filesystem():
         # use shutil.copytree if the target does not exist yet (no need to merge copy)
         if not os.path.exists(dst):
             try:
-                return shutil.copytree(src, dst, ignore=Filesystem.shutil_ignore_patterns)
+                return shutil.copytree(src, dst, ignore=Filesystem.shutil_ignore_patterns,
+                                       copy_function=Filesystem.clone_file)
             except shutil.Error:
                 short_src = os.path.sep.join(src.split(os.path.sep)[
                                              :3]) + os.path.sep + "…"
@@ -124,7 +363,8 @@ class Filesystem():
                     if item not in dst_list:
                         try:
                             shutil.copytree(
-                                src_subpath, dst_subpath, ignore=Filesystem.shutil_ignore_patterns)
+                                src_subpath, dst_subpath, ignore=Filesystem.shutil_ignore_patterns,
+                                copy_function=Filesystem.clone_file)
                         except shutil.Error:
                             short_src = os.path.sep.join(src.split(os.path.sep)[
                                                          :3]) + os.path.sep + "…"
@@ -138,15 +378,11 @@ class Filesystem():
                 else:
                     # Report files that have changed but where the target could not be overwritten
                     if os.path.exists(dst_subpath):
-                        src_md5 = Filesystem.path_md5(
-                            src_subpath, shallow=False)
-                        dst_md5 = Filesystem.path_md5(
-                            dst_subpath, shallow=False)
-                        if src_md5 != dst_md5:
+                        if not Filesystem.files_equal(src_subpath, dst_subpath):
                             report.error(
                                 "Klarte ikke å erstatte filen med nyere versjon: " + dst_subpath)
                     else:
-                        shutil.copy(src_subpath, dst_subpath)
+                        Filesystem.clone_file(src_subpath, dst_subpath)
 
         # Report files and folders that could not be removed and were not supposed to be replaced
         for item in dst_list:
@@ -162,6 +398,14 @@ class Filesystem():
 
         return dst
 
+    @staticmethod
+    def workspace(report, source, destination):
+        """
+        Make a copy-on-write working copy of the `source` directory in `destination`.
+        See CopyOnWriteWorkspace.
+        """
+        return CopyOnWriteWorkspace(report, source, destination)
+
     @staticmethod
     def copy(report, source, destination):
         """Copy the `source` file or directory to the `destination`"""
@@ -246,13 +490,161 @@ class Filesystem():
             Filesystem.copy(report, archive, target)
 
         else:
+            try:
+                Filesystem.extract_zip(archive, target)
+            except (EOFError, zipfile.BadZipFile) as e:
+                report.error(
+                    "En feil oppstod ved lesing av ZIP-filen. Kanskje noen endret eller slettet den?")
+                report.debug(traceback.format_exc(), preformatted=True)
+                raise e
+            except UnsafeArchiveError as e:
+                report.error("ZIP-filen ble ikke pakket ut: " + str(e))
+                raise e
+
+    @staticmethod
+    def check_zip_limits(infolist,
+                         max_total_size=None,
+                         max_entries=None,
+                         max_ratio=None):
+        """
+        Check the entries of a ZIP file against the extraction limits, without extracting anything.
+        Returns a list of problems; an empty list means that the archive is safe to extract.
+
+        Sizes are read from the central directory. ZipFile never reads more than the declared size
+        of an entry, so the declared sizes are an upper bound for what is written to disk.
+        """
+        max_total_size = Filesystem.unzip_max_total_size if max_total_size is None else max_total_size
+        max_entries = Filesystem.unzip_max_entries if max_entries is None else max_entries
+        max_ratio = Filesystem.unzip_max_ratio if max_ratio is None else max_ratio
+
+        problems = []
+        if len(infolist) > max_entries:
+            problems.append("ZIP-filen inneholder {} filer, men maks er {}".format(
+                len(infolist), max_entries))
+
+        total_size = sum(info.file_size for info in infolist)
+        if total_size > max_total_size:
+            problems.append("ZIP-filen er {} bytes utpakket, men maks er {} bytes".format(
+                total_size, max_total_size))
+
+        for info in infolist:
+            name = info.filename.replace("\\", "/")
+            if name.startswith("/") or ".." in name.split("/") or re.match(r"^[A-Za-z]:", name):
+                problems.append("Ugyldig filsti i ZIP-filen: " + info.filename)
+            # small entries are allowed to have a high compression ratio (for instance empty files)
+            if info.file_size > 1024 * 1024 and info.file_size > max_ratio * max(info.compress_size, 1):
+                problems.append("Mistenkelig høy komprimeringsgrad for {} ({} -> {} bytes)".format(
+                    info.filename, info.compress_size, info.file_size))
+
+        return problems
+
+    @staticmethod
+    def extract_zip(archive, target, workers=None):
+        """
+        Extract `archive` into the directory `target`.
+
+        The archive is checked against the limits in check_zip_limits before anything is extracted.
+        Entries are streamed to disk in chunks, and permissions are set as each file and directory
+        is created (directories 777, files 664), so no second pass over the tree is needed.
+        Large archives are extracted in parallel, with one ZipFile handle per thread.
+        """
+        workers = Filesystem.unzip_workers if workers is None else workers
+
+        with zipfile.ZipFile(archive, "r") as zip_ref:
+            infolist = zip_ref.infolist()
+
+        problems = Filesystem.check_zip_limits(infolist)
+        if problems:
+            raise UnsafeArchiveError("; ".join(problems))
+
+        os.chmod(target, 0o777)
+
+        # create all directories first, so that the files can be extracted in any order
+        directories = set()
+        for info in infolist:
+            parts = info.filename.replace("\\", "/").strip("/").split("/")
+            for i in range(1, len(parts) + (1 if info.is_dir() else 0)):
+                directories.add("/".join(parts[:i]))
+        for directory in sorted(directories):
+            path = os.path.join(target, *directory.split("/"))
+            if not os.path.isdir(path):
+                os.mkdir(path)
+            os.chmod(path, 0o777)
+
+        # if the same path occurs more than once, the last entry wins (as with ZipFile.extractall)
+        files = list({info.filename.replace("\\", "/"): info for info in infolist if not info.is_dir()}.values())
+        total_size = sum(info.file_size for info in files)
+
+        def extract(entries):
             with zipfile.ZipFile(archive, "r") as zip_ref:
-                try:
-                    zip_ref.extractall(target)
-                except EOFError as e:
-                    report.error(
-                        "En feil oppstod ved lesing av ZIP-filen. Kanskje noen endret eller slettet den?")
-                    report.debug(traceback.format_exc(), preformatted=True)
-                    raise e
-
-            Filesystem.fix_permissions(target)
+                for info in entries:
+                    path = os.path.join(target, *info.filename.replace("\\", "/").split("/"))
+                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o664)
+                    os.fchmod(fd, 0o664)  # not affected by umask
+                    with zip_ref.open(info) as source, os.fdopen(fd, "wb") as destination:
+                        shutil.copyfileobj(source, destination, Filesystem.hash_chunk_size)
+
+        if workers <= 1 or len(files) < 2 or total_size < Filesystem.unzip_parallel_threshold:
+            extract(files)
+            return
+
+        # distribute the entries so that each thread gets about the same amount of data
+        buckets = [[] for _ in range(workers)]
+        sizes = [0] * workers
+        for info in sorted(files, key=lambda info: info.file_size, reverse=True):
+            smallest = sizes.index(min(sizes))
+            buckets[smallest].append(info)
+            sizes[smallest] += info.file_size
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(extract, bucket) for bucket in buckets if bucket]:
+                future.result()
+
+
+class CopyOnWriteWorkspace():
+    """
+    A working copy of a directory tree, where the files share their data with the source.
+
+    Files are reflinked where the filesystem supports it, and hardlinked otherwise, so creating
+    the workspace writes (almost) nothing to disk. Reflinked files can be modified freely.
+    A hardlinked file shares its data with the source, so call `writable(path)` before writing
+    to a file in the workspace. The link is then broken by replacing the file with a real copy.
+    Deleting, renaming and adding files does not affect the source.
+    """
+
+    def __init__(self, report, source, destination):
+        assert os.path.isdir(source), "CopyOnWriteWorkspace: source must be a directory: " + str(source)
+        assert not os.path.exists(destination) or not os.listdir(destination), \
+            "CopyOnWriteWorkspace: destination must be empty or not exist: " + str(destination)
+        self.report = report
+        self.source = source
+        self.path = destination
+        self.linked = set()
+
+        report.debug("Creating workspace for '" + source + "' in '" + destination + "'")
+        for root, dirs, files in os.walk(source):
+            ignore = Filesystem.shutil_ignore_patterns(root, dirs + files)
+            dirs[:] = [d for d in dirs if d not in ignore]
+            target_root = os.path.join(destination, os.path.relpath(root, source))
+            os.makedirs(target_root, exist_ok=True)
+            for file in files:
+                if file in ignore:
+                    continue
+                src = os.path.join(root, file)
+                dst = os.path.join(target_root, file)
+                Filesystem.clone_file(src, dst, hardlink=True)
+                if os.path.samefile(src, dst):
+                    self.linked.add(os.path.abspath(dst))
+
+    def writable(self, path):
+        """Make sure that `path` no longer shares data with the source, so that it can be written to. Returns `path`."""
+        path = os.path.abspath(path)
+        if path in self.linked:
+            temp_path = path + ".cow-tmp"
+            shutil.copy2(path, temp_path)
+            os.replace(temp_path, path)
+            self.linked.discard(path)
+        return path
+
+    def remove(self, path):
+        os.remove(path)
+        self.linked.discard(os.path.abspath(path))
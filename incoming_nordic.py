@@ -12,6 +12,8 @@ from lxml import etree as ElementTree
 import xml.etree.ElementTree as ET
 
 from filesystem import Filesystem
+from pre_validation import find_image_errors
+from tracing import Trace
 
 XSLT_DIR = os.environ.get("XSLT")
 
@@ -23,14 +25,19 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def create_epub_no_img(epub_file):
+def create_epub_no_img(epub_file, output_dir=None, trace=None, epub=None):
+    """
+    `epub` can be an already unpacked Epub of `epub_file` (see JobArtifacts), so that
+    it isn't unpacked again. It is only read from, never modified.
+    """
+    trace = trace or Trace()
     uid = "incoming-nordic"
     title = "Validering av Nordisk EPUB 3"
     labels = ["EPUB", "Statped"]
     publication_format = None
     expected_processing_time = 1400
     logger.info("Starter validering av Nordisk EPUB 3----" + uid)
-    epub = Epub(logger, epub_file)
+    epub = epub or Epub(logger, epub_file)
     epubTitle = ""
     try:
         epubTitle = " (" + epub.meta("dc:title") + ") "
@@ -87,9 +94,13 @@ def create_epub_no_img(epub_file):
         tree.write(html_file, method="xml", encoding="UTF-8")
 
     logger.info("Lager en kopi av EPUBen med tomme bildefiler")
-    temp_noimages_epubdir_obj = tempfile.TemporaryDirectory()
+    temp_noimages_epubdir_obj = tempfile.TemporaryDirectory(dir=output_dir)
     temp_noimages_epubdir = temp_noimages_epubdir_obj.name
-    Filesystem.copy(logger, epub.asDir(), temp_noimages_epubdir)
+    # files are shared with the unzipped EPUB until they are written to
+    with trace.span("workspace"):
+        workspace = Filesystem.workspace(
+            logger, epub.asDir(), temp_noimages_epubdir)
+    rewrite_span = trace.start("rewrite")
     if os.path.isdir(os.path.join(temp_noimages_epubdir, "EPUB", "images")):
         temp_xml_obj = tempfile.NamedTemporaryFile()
         temp_xml = temp_xml_obj.name
@@ -122,7 +133,7 @@ def create_epub_no_img(epub_file):
                             image_item.getparent().remove(image_item)
 
                     opf_xml_document.write(
-                        opf_file, method='XML', xml_declaration=True, encoding='UTF-8', pretty_print=False)
+                        workspace.writable(opf_file), method='XML', xml_declaration=True, encoding='UTF-8', pretty_print=False)
 
                 if file.endswith(".xhtml"):
                     html_file = os.path.join(root, file)
@@ -145,7 +156,7 @@ def create_epub_no_img(epub_file):
                     logger.debug("dummy-jpg.xsl")
                     logger.debug("    source = " + html_file)
                     logger.debug("    target = " + temp_xml)
-                    transform_xhtml(html_file)
+                    transform_xhtml(workspace.writable(html_file))
                     """xslt = Xslt(self,
                                 stylesheet=os.path.join(Xslt.xslt_dir, IncomingNordic.uid, "dummy-jpg.xsl"),
                                 source=html_file,
@@ -164,21 +175,11 @@ def create_epub_no_img(epub_file):
                     fullpath, os.path.join(temp_noimages_epubdir, "EPUB"))
                 image_files_present.append(relpath)
         image_error = False
-        for file in image_files_present:
-            if file not in opf_image_references:
-                logger.error("Bildefilen er ikke deklarert i OPFen: " + file)
-                image_error = True
-        for file in opf_image_references:
-            if file not in image_files_present:
-                logger.error(
-                    "Bildefilen er deklarert i OPFen, men finnes ikke: " + file)
-                image_error = True
-        for file in html_image_references:
-            if file not in opf_image_references:
-                logger.error("Bildefilen er deklarert i HTMLen, men finnes ikke: " + file
-                             + " (deklarert i: " + ", ".join(html_image_references[file]) + ")")
-                image_error = True
+        for message, file in find_image_errors(image_files_present, opf_image_references, html_image_references):
+            logger.error(message)
+            image_error = True
         if image_error:
+            trace.finish(rewrite_span, error="images")
             logger.info(epub.identifier() + " feilet 😭👎" + epubTitle)
             return {
                 "status": "error",
@@ -190,16 +191,19 @@ def create_epub_no_img(epub_file):
                 if file == "cover.jpg":
                     continue  # don't delete the cover file
                 fullpath = os.path.join(root, file)
-                os.remove(fullpath)
+                workspace.remove(fullpath)
         shutil.copy(os.path.join(XSLT_DIR, uid, "reference-files", "demobilde.jpg"),
                     os.path.join(temp_noimages_epubdir, "EPUB", "images", "dummy.jpg"))
+    trace.finish(rewrite_span)
     temp_noimages_epub = Epub(logger, temp_noimages_epubdir)
 
     logger.info("Validerer EPUB med epubcheck og nordiske retningslinjer...")
-    epub_noimages_file = temp_noimages_epub.asFile()
+    with trace.span("rezip"):
+        epub_noimages_file = temp_noimages_epub.asFile()
 
-    epub_file_path = os.path.join("/tmp", os.path.basename(epub_noimages_file))
-    shutil.copy(epub_noimages_file, epub_file_path)
+        epub_file_path = os.path.join(
+            output_dir or "/tmp", os.path.basename(epub_noimages_file))
+        shutil.copy(epub_noimages_file, epub_file_path)
 
     return {
         "status": "ok",
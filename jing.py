@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import subprocess
+import traceback
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from epub import Epub
+from filesystem import Filesystem
+from xslt import Xslt
+
+
+JING_SCHEMA_XHTML = os.environ.get("JING_SCHEMA_XHTML")
+JING_SCHEMA_OPF = os.environ.get("JING_SCHEMA_OPF")
+JING_WORKERS = int(os.environ.get("JING_WORKERS", "4"))
+
+
+class Jing():
+    """
+    Class used to validate documents with the bundled Jing jar (RelaxNG, and ISO Schematron with Saxon on the classpath).
+
+    All documents that use the same schema are validated in one JVM, since starting
+    the JVM is the expensive part; Jing reports the errors per document.
+    """
+
+    driver = "com.thaiopensource.relaxng.util.Driver"
+    message_pattern = re.compile(
+        r"^(?P<document>.+?):(?P<line>\d+):(?P<column>\d+): (?:(?P<severity>error|warning|fatal): )?(?P<message>.*)$")
+
+    schemas = {
+        "opf": JING_SCHEMA_OPF,
+        "xhtml": JING_SCHEMA_XHTML,
+    }
+
+    def __init__(self, report, schema, documents, timeout=600):
+        assert report
+        assert schema
+        self.report = report
+        # Jing runs in the directory of the schema, so relative paths would be resolved against it
+        self.schema = os.path.abspath(schema)
+        self.documents = [os.path.abspath(document) for document in documents]
+        self.timeout = timeout
+        # "valid" stays None for documents that Jing wasn't able to validate
+        self.results = {document: {"document": document, "valid": None, "errors": []}
+                        for document in self.documents}
+        self.success = False
+
+        if self.documents:
+            self.run()
+        else:
+            self.success = True
+
+    def command(self):
+        classpath = [os.path.abspath(Xslt.jing_jar)]
+        if Xslt.saxon_jar:
+            # Saxon is needed when the schema is ISO Schematron
+            classpath.append(os.path.abspath(Xslt.saxon_jar))
+        return ["java", "-cp", os.pathsep.join(classpath), Jing.driver, self.schema] + self.documents
+
+    def run(self):
+        Xslt.init_environment()
+        if not Xslt.jing_jar:
+            self.report.error("JING_JAR er ikke satt. Kan ikke validere med Jing.")
+            return
+
+        try:
+            # the errors are parsed while Jing runs, so that the whole output is never kept in memory
+            process = Filesystem.run_static_streaming(self.command(), os.path.dirname(self.schema), None,
+                                                      timeout=self.timeout, check=False,
+                                                      line_callback=lambda stream, line: self.parse_line(line))
+        except subprocess.TimeoutExpired:
+            self.report.error(
+                "Valideringen med {} tok for lang tid og ble derfor stoppet.".format(os.path.basename(self.schema)))
+            return
+        except Exception:
+            self.report.debug(traceback.format_exc())
+            self.report.error(
+                "An error occured while running Jing (" + str(self.schema) + ")")
+            return
+
+        # exit code 1 means that at least one document is invalid, anything else is a failure in Jing itself
+        self.success = process.returncode == 0 or (
+            process.returncode == 1 and any(r["valid"] is False for r in self.results.values()))
+        if not self.success:
+            self.report.error("Jing feilet med returkode {} ({})".format(
+                process.returncode, os.path.basename(self.schema)))
+            return
+
+        for result in self.results.values():
+            if result["valid"] is None:
+                result["valid"] = True
+
+    def parse_line(self, line):
+        match = Jing.message_pattern.match(line.strip())
+        if not match:
+            return
+        document = match.group("document")
+        if document.startswith("file:"):
+            document = urllib.parse.unquote(
+                urllib.parse.urlparse(document).path)
+        if document not in self.results:
+            # an error in the schema itself, or in a document referenced from it
+            self.report.error(line.strip())
+            return
+        severity = match.group("severity") or "error"
+        self.results[document]["errors"].append({
+            "line": int(match.group("line")),
+            "column": int(match.group("column")),
+            "severity": severity,
+            "message": match.group("message"),
+        })
+        if severity != "warning":
+            self.results[document]["valid"] = False
+
+    @staticmethod
+    def validate_epub(report, epub_path, schemas=None, epub=None):
+        """
+        Validate the package document and the XHTML content documents of an EPUB.
+        Returns a list with one result per document, with paths relative to the root of the EPUB.
+        `epub` can be an already unpacked Epub of `epub_path`.
+        """
+        schemas = schemas or Jing.schemas
+        epub = epub or Epub(report, epub_path)
+        if not epub.isepub():
+            return None
+
+        book_dir = epub.asDir()
+        opf_path = os.path.join(book_dir, epub.opf_path())
+        documents = {"opf": [opf_path], "xhtml": []}
+        for href in epub.get_opf_package_element().xpath(
+                "/*/*[local-name()='manifest']/*[@media-type='application/xhtml+xml']/@href"):
+            documents["xhtml"].append(os.path.normpath(
+                os.path.join(os.path.dirname(opf_path), href)))
+
+        results = []
+        for schema_type, paths in documents.items():
+            schema = schemas.get(schema_type)
+            if not schema:
+                continue
+            jing = Jing(report, schema, paths)
+            for result in jing.results.values():
+                result = dict(result, schema=os.path.basename(schema))
+                result["document"] = os.path.relpath(result["document"], book_dir)
+                results.append(result)
+        return results
+
+    @staticmethod
+    def validate_epubs(report, epub_paths, schemas=None, workers=JING_WORKERS):
+        """Validate several EPUBs in parallel. Returns a dict from EPUB path to the per-document results."""
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                lambda path: Jing.validate_epub(report, path, schemas), epub_paths)
+            return dict(zip(epub_paths, results))
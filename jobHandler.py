@@ -9,6 +9,10 @@ import logging
 from daisy_pipeline_light import RemoteDaisyPipelineJob
 from incoming_nordic import create_epub_no_img
 from utils import remove_file
+from filesystem import Filesystem
+from job_events import job_events
+from metrics import REMOTE_WAIT
+from tracing import Trace
 
 
 logging.basicConfig(
@@ -26,10 +30,21 @@ class JobStepHandler:
         self.epub_path = job["epub_path"]
         self.log_handler = job["log_handler"]
         self.filename = job["filename"]
+        self.workspace = job.get("workspace")
+        self.trace = job.get("trace") or Trace(self.reference)
+        self.artifacts = job["artifacts"]
+        self.cancelled = job["cancelled"]
 
     def run_step_create_epub_no_img(self):
         print(f"Running step: create-epub-no-img for job {self.reference}")
-        result = create_epub_no_img(self.epub_path)
+        # the EPUB is unzipped here, unless pre-validation has done it already
+        with self.trace.span("unzip", cached=self.artifacts.epub is not None):
+            epub = self.artifacts.acquire()
+        try:
+            result = create_epub_no_img(
+                self.epub_path, self.workspace.path if self.workspace else None, self.trace, epub)
+        finally:
+            self.artifacts.release()
         if result.get("status") == "error":
             return False
         self.job["epub_path"] = result["file"]
@@ -50,9 +65,11 @@ class JobStepHandler:
         epub_file_path = self.job["epub_path"]
         epub_filename = os.path.basename(epub_file_path)
 
-        temp_dir = tempfile.mkdtemp()
+        temp_dir = self.workspace.mkdtemp(
+            step_name + "-") if self.workspace else tempfile.mkdtemp()
         copied_path = os.path.join(temp_dir, epub_filename)
-        shutil.copy(epub_file_path, copied_path)
+        # the copy is only read, so a link to the same data is enough
+        Filesystem.clone_file(epub_file_path, copied_path, hardlink=True)
 
         init_args = {
             "script_id": script_id,
@@ -64,23 +81,52 @@ class JobStepHandler:
                          ("1.12.1", "1.4.2"),
                          ],
             "log_handler": self.log_handler,
+            "temp_dir": temp_dir,
+            "trace": self.trace,
         }
 
         job = RemoteDaisyPipelineJob(**init_args)
         result = job.run()
         job_id = result.get("job_id")
+        posted = time.monotonic()
+        remote_span = self.trace.start("remote-run", "remote", engine=job.engine["endpoint"],
+                                       script=script_id, job_id=job_id)
         status = "RUNNING"
         timeout = time.time() + 600  # 10 min
 
+        last_status = None
+
         while status in ("RUNNING", "IDLE") and time.time() < timeout:
+            if self.cancelled.is_set():
+                logger.info(f"Job {self.reference} is cancelled, deleting remote job {job_id}")
+                job.delete(job_id)
+                self.trace.finish(remote_span, status="CANCELLED")
+                return False
             status = job.get_status(job_id)
             logger.info(f"Job {job_id} status: {status}")
+            if status != last_status:
+                job_events.publish(self.reference, "remote-status", {
+                    "step": step_name,
+                    "job_id": job_id,
+                    "engine": job.engine["endpoint"],
+                    "status": status,
+                })
+                last_status = status
+            if status not in ("IDLE", "RUNNING"):
+                self.trace.finish(remote_span, status=status)
+                REMOTE_WAIT.observe(time.monotonic() - posted,
+                                    engine=job.engine["endpoint"], script=script_id)
             if status == "DONE":
                 job.download_all(job_id)
+                self.job.setdefault("outputs", {})[step_name] = job.dir_output
+                if self.workspace:
+                    self.workspace.keep(job.dir_output)
                 return True
             elif status not in ("IDLE", "RUNNING"):
                 return False
-            time.sleep(5)
+            # wakes up at once when the job is cancelled
+            self.cancelled.wait(5)
+        self.trace.finish(remote_span, status=status)
         """ try:
             epub_path = self.job["epub_path"]
             if os.path.exists(epub_path):
@@ -0,0 +1,76 @@
+import asyncio
+import sys
+import logging
+import threading
+from datetime import datetime
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+FINAL_STATUSES = ("SUCCESS", "ERROR", "CANCELLED")
+
+
+class JobEventBroker:
+    """
+    Keeps the event history of every job and pushes new events to subscribers.
+
+    Events are published from the worker thread and consumed by the
+    async endpoints, so every subscriber is an asyncio.Queue bound to the
+    event loop it was created on.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._history = {}
+        self._subscribers = {}
+
+    def publish(self, reference, event, data):
+        with self._lock:
+            history = self._history.setdefault(reference, [])
+            entry = {
+                "id": len(history),
+                "event": event,
+                "time": datetime.utcnow().isoformat(),
+                "data": data,
+            }
+            history.append(entry)
+            subscribers = list(self._subscribers.get(reference, []))
+
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, entry)
+            except RuntimeError:
+                # the event loop of the subscriber is closed
+                self.unsubscribe(reference, queue)
+
+    def subscribe(self, reference):
+        """Returns the events published so far, and a queue receiving the next ones."""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        with self._lock:
+            history = list(self._history.get(reference, []))
+            self._subscribers.setdefault(reference, []).append((loop, queue))
+        return history, queue
+
+    def unsubscribe(self, reference, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(reference, [])
+            subscribers[:] = [s for s in subscribers if s[1] is not queue]
+            if not subscribers:
+                self._subscribers.pop(reference, None)
+
+    def discard(self, reference):
+        with self._lock:
+            self._history.pop(reference, None)
+
+    @staticmethod
+    def is_final(entry):
+        return entry["event"] == "job" and entry["data"].get("status") in FINAL_STATUSES
+
+
+job_events = JobEventBroker()
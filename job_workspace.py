@@ -0,0 +1,251 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from epub import Epub
+from filesystem import Filesystem
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+JOB_WORKSPACE_ROOT = os.environ.get("JOB_WORKSPACE_ROOT") or os.path.join(
+    tempfile.gettempdir(), "nordic_to_bok_jobs")
+JOB_WORKSPACE_TTL = int(os.environ.get("JOB_WORKSPACE_TTL", str(24 * 3600)))
+JOB_WORKSPACE_MAX_DISK_USAGE = float(
+    os.environ.get("JOB_WORKSPACE_MAX_DISK_USAGE", "0.9"))
+JOB_WORKSPACE_QUOTA = int(os.environ.get("JOB_WORKSPACE_QUOTA", "0"))
+JOB_WORKSPACE_SWEEP_INTERVAL = int(
+    os.environ.get("JOB_WORKSPACE_SWEEP_INTERVAL", "300"))
+
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class JobWorkspace:
+    """
+    All scratch files and directories of one job live in one directory, so that they can
+    be removed together. Paths registered with keep() survive finish(), and are removed
+    together with the rest of the workspace when its TTL expires. The TTL counts from
+    finish(), or from creation for a workspace that is never finished.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.kept = set()
+        self.created = time.time()
+        self.finished = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def mkdtemp(self, prefix=None):
+        return tempfile.mkdtemp(prefix=prefix, dir=self.path)
+
+    def mkstemp(self, suffix=None, prefix=None):
+        """Create a temporary file in the workspace and return its path (the file is closed)."""
+        fd, path = tempfile.mkstemp(suffix=suffix, prefix=prefix, dir=self.path)
+        os.close(fd)
+        return path
+
+    def keep(self, path):
+        self.kept.add(os.path.abspath(path))
+        return path
+
+    def disk_usage(self):
+        return directory_size(self.path)
+
+    def expired(self, now, ttl):
+        return now - (self.finished or self.created) > ttl
+
+    def finish(self):
+        """Remove everything except the kept paths."""
+        self.finished = time.time()
+        if os.path.isdir(self.path):
+            self._remove_unkept(self.path)
+
+    def _remove_unkept(self, directory):
+        for entry in os.listdir(directory):
+            path = os.path.abspath(os.path.join(directory, entry))
+            if path in self.kept:
+                continue
+            if any(kept.startswith(path + os.sep) for kept in self.kept):
+                self._remove_unkept(path)
+            elif os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class JobArtifacts:
+    """
+    The unpacked EPUB of a job, shared by all the steps that read it, so that the EPUB is
+    unpacked once per job. The shared Epub instance also caches the parsed package document.
+
+    The job itself holds the first reference. Steps use the EPUB inside use(), and the
+    unpacked tree is removed when the last reference is released. Steps must not modify
+    the tree; Filesystem.workspace gives a copy-on-write view of it for that.
+    """
+
+    def __init__(self, epub_path, directory, report=logger):
+        self.epub_path = epub_path
+        self.directory = directory
+        self.report = report
+        self.references = 1
+        self.epub = None
+        self.unpacked = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a reference, and return the shared Epub, unpacking it if needed."""
+        with self.lock:
+            if self.epub is None:
+                target = tempfile.mkdtemp(prefix="epub-", dir=self.directory)
+                try:
+                    Filesystem.unzip(self.report, self.epub_path, target)
+                except Exception:
+                    shutil.rmtree(target, ignore_errors=True)
+                    raise
+                self.epub = Epub(self.report, target)
+                self.unpacked += 1
+            self.references += 1
+            return self.epub
+
+    def release(self):
+        with self.lock:
+            self.references -= 1
+            if self.references > 0 or self.epub is None:
+                return
+            path = self.epub.asDir()
+            self.epub = None
+        shutil.rmtree(path, ignore_errors=True)
+
+    @contextmanager
+    def use(self):
+        epub = self.acquire()
+        try:
+            yield epub
+        finally:
+            self.release()
+
+
+class JobWorkspaceManager:
+    """
+    Owns the workspaces of all jobs under one root directory: removes them when jobs finish
+    or their TTL expires, keeps track of disk usage, and refuses new jobs above the
+    disk high-water mark.
+    """
+
+    def __init__(self, root=JOB_WORKSPACE_ROOT, ttl=JOB_WORKSPACE_TTL,
+                 max_disk_usage=JOB_WORKSPACE_MAX_DISK_USAGE, quota=JOB_WORKSPACE_QUOTA):
+        self.root = root
+        self.ttl = ttl
+        self.max_disk_usage = max_disk_usage
+        self.quota = quota
+        self.workspaces = {}
+        self.usage = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def create(self, reference):
+        path = os.path.join(self.root, reference)
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.root):
+            raise ValueError(f"Not a valid workspace name: {reference!r}")
+        with self.lock:
+            workspace = self.workspaces.get(reference)
+            if workspace is None:
+                workspace = JobWorkspace(path)
+                self.workspaces[reference] = workspace
+            return workspace
+
+    def get(self, reference):
+        with self.lock:
+            return self.workspaces.get(reference)
+
+    def finish(self, reference):
+        workspace = self.get(reference)
+        if workspace:
+            workspace.finish()
+
+    def remove(self, reference):
+        with self.lock:
+            workspace = self.workspaces.pop(reference, None)
+        if workspace:
+            workspace.remove()
+
+    def has_capacity(self):
+        """Returns (True, None) if new jobs can be accepted, otherwise (False, reason)."""
+        disk = shutil.disk_usage(self.root)
+        if disk.used / disk.total > self.max_disk_usage:
+            return False, "Disk usage is above {:.0%}".format(self.max_disk_usage)
+        if self.quota and self.usage > self.quota:
+            return False, "Job workspaces use {} bytes, the quota is {} bytes".format(self.usage, self.quota)
+        return True, None
+
+    def status(self):
+        disk = shutil.disk_usage(self.root)
+        with self.lock:
+            count = len(self.workspaces)
+        return {
+            "root": self.root,
+            "workspaces": count,
+            "usage": self.usage,
+            "quota": self.quota,
+            "disk_used": disk.used,
+            "disk_total": disk.total,
+            "max_disk_usage": self.max_disk_usage,
+        }
+
+    def sweep(self):
+        """Remove workspaces whose TTL has expired, including leftovers from earlier runs, and update the disk usage."""
+        now = time.time()
+        with self.lock:
+            known = dict(self.workspaces)
+
+        for reference, workspace in known.items():
+            if workspace.expired(now, self.ttl):
+                logger.info(f"Removing expired workspace for job {reference}")
+                self.remove(reference)
+
+        for entry in os.listdir(self.root):
+            path = os.path.join(self.root, entry)
+            if entry in known:
+                continue
+            try:
+                if now - os.stat(path).st_mtime > self.ttl:
+                    logger.info(f"Removing orphaned workspace: {path}")
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+        self.usage = directory_size(self.root)
+        return self.usage
+
+    def run_sweeper(self, interval=JOB_WORKSPACE_SWEEP_INTERVAL):
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Sweeping job workspaces failed")
+            time.sleep(interval)
+
+
+job_workspaces = JobWorkspaceManager()
@@ -0,0 +1,142 @@
+"""
+Load test of the job path: submits N synthetic books concurrently to a running app, waits
+for all of them to finish, and reports throughput and latency percentiles as JSON.
+
+Run the app against the mock Pipeline 2 to test the app alone:
+
+    python mock_pipeline2.py --port 8181 --latency 20 --jitter 5
+    REMOTE_PIPELINE2_WS_ENDPOINTS=http://localhost:8181/ws uvicorn main:app --port 8000
+    python load_test.py --url http://localhost:8000 --books 50 --concurrency 10
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+import httpx
+
+from benchmark import generate_nordic_epub
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    # nearest-rank percentile
+    index = min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))
+    return values[index]
+
+
+async def run_book(client, url, epub_path, poll_interval, timeout):
+    """Submit one book and wait for the result. Returns a dict with the outcome and the timings."""
+    started = time.monotonic()
+    with open(epub_path, "rb") as f:
+        response = await client.post(url + "/validate_nordic_epub/",
+                                      files={"epub": (os.path.basename(epub_path), f, "application/epub+zip")},
+                                      data={"source": "load-test"})
+    submitted = time.monotonic()
+    result = {"submit_seconds": submitted - started, "submit_status": response.status_code}
+    if response.status_code != 202:
+        result["status"] = "REJECTED"
+        return result
+
+    reference = response.json()["reference_number"]
+    result["reference_number"] = reference
+    while time.monotonic() - started < timeout:
+        await asyncio.sleep(poll_interval)
+        response = await client.get(url + "/checkstatus/" + reference)
+        if response.status_code == 202:
+            continue
+        result["status"] = response.headers.get("X-Job-Status") or "HTTP {}".format(response.status_code)
+        result["total_seconds"] = time.monotonic() - started
+        result["result_bytes"] = len(response.content) if response.status_code == 200 else 0
+        return result
+
+    result["status"] = "TIMEOUT"
+    result["total_seconds"] = time.monotonic() - started
+    return result
+
+
+async def run(url, books, concurrency, documents, images, poll_interval, timeout):
+    with tempfile.TemporaryDirectory() as books_dir:
+        epub_paths = [generate_nordic_epub(os.path.join(books_dir, "{:06}.epub".format(100000 + i)),
+                                           identifier=str(100000 + i), documents=documents, images=images)
+                      for i in range(books)]
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(client, epub_path):
+            async with semaphore:
+                return await run_book(client, url, epub_path, poll_interval, timeout)
+
+        started = time.monotonic()
+        async with httpx.AsyncClient(timeout=60) as client:
+            results = await asyncio.gather(*[limited(client, path) for path in epub_paths])
+        wall_seconds = time.monotonic() - started
+
+    latencies = [result["total_seconds"] for result in results
+                 if result["status"] not in ("REJECTED", "TIMEOUT")]
+    submit_latencies = [result["submit_seconds"] for result in results]
+    statuses = {}
+    for result in results:
+        statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+
+    return {
+        "url": url,
+        "books": books,
+        "concurrency": concurrency,
+        "documents": documents,
+        "images": images,
+        "wall_seconds": wall_seconds,
+        "throughput_jobs_per_minute": len(latencies) / wall_seconds * 60 if wall_seconds else None,
+        "statuses": statuses,
+        "latency_seconds": {
+            "mean": statistics.mean(latencies) if latencies else None,
+            "p50": percentile(latencies, 0.50),
+            "p90": percentile(latencies, 0.90),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies) if latencies else None,
+        },
+        "submit_latency_seconds": {
+            "p50": percentile(submit_latencies, 0.50),
+            "p99": percentile(submit_latencies, 0.99),
+        },
+        "jobs": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app with synthetic Nordic EPUBs.")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--books", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=5,
+                        help="How many books are in flight at the same time")
+    parser.add_argument("--documents", type=int, default=10)
+    parser.add_argument("--images", type=int, default=10)
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--timeout", type=float, default=3600.0,
+                        help="Give up on a book after this many seconds")
+    parser.add_argument("--output", help="Write the results as JSON to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.url.rstrip("/"), args.books, args.concurrency, args.documents,
+                             args.images, args.poll_interval, args.timeout))
+    print("{} books in {:.1f} s, {} per minute, p50 {} s, p99 {} s, {}".format(
+        args.books, report["wall_seconds"], report["throughput_jobs_per_minute"],
+        report["latency_seconds"]["p50"], report["latency_seconds"]["p99"], report["statuses"]), file=sys.stderr)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
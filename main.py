@@ -10,32 +10,49 @@ import shutil
 import subprocess
 import time
 import json
+import math
+import heapq
 import threading
 import datetime
 import logging
+import asyncio
 import zipfile
 import xml.etree.ElementTree as ET
-from typing import Optional, Union
-from datetime import datetime
+from typing import List, Optional, Union
+from datetime import datetime, timedelta
 from contextlib import asynccontextmanager
 
 import httpx
 
 from bs4 import BeautifulSoup
 
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
 from fastapi.responses import JSONResponse
 from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse
 from fastapi import BackgroundTasks
+from pydantic import BaseModel
 
 from dotenv import load_dotenv
 
 from daisy_pipeline_light import RemoteDaisyPipelineJob  # your simplified class
-from utils import remove_file, generate_reference_number
+from utils import remove_file, generate_reference_number, safe_name
+from filesystem import Filesystem, UnsafeArchiveError
+from job_workspace import job_workspaces, JobArtifacts
+from result_store import result_store
+from metrics import REGISTRY, Gauge, JOBS_SUBMITTED, JOBS_FINISHED, QUEUE_WAIT, STEP_DURATION, UPLOAD_BYTES
 from incoming_nordic import create_epub_no_img  # your EPUB validation function
+from pre_validation import pre_validate_epub, ZIP_ERRORS
 from nordic_to_nlbpub import get_nordic_guidelines_version, nordic_to_nlbpub_with_migrator
 
 from jobHandler import JobStepHandler
+from job_events import job_events, FINAL_STATUSES
+from migrator_pool import migrator_pool
+from tracing import Trace
+from scheduler import FairShareQueue
+from estimates import step_durations, start_after
+from engine_health import engine_monitor
 
 load_dotenv()
 
@@ -49,9 +66,21 @@ current_running_job_name = None
 current_running_job_source = None
 
 
-job_queue = []
+job_queue = FairShareQueue()
 db_lock = threading.Lock()
 over_all_job_registry = {}
+# references of the jobs that the workers are running
+running_jobs = set()
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "1"))
+JOB_STEPS = ["create-epub-no-img", "incoming-nordic", "nordic-epub3-to-html"]
+
+# admission control: new jobs are refused with 429 when the queue is longer than ADMISSION_MAX_QUEUE jobs,
+# or when a new job would wait more than ADMISSION_MAX_WAIT seconds before it starts. 0 means no limit.
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "0"))
+ADMISSION_MAX_WAIT = int(os.environ.get("ADMISSION_MAX_WAIT", "0"))
+# the longest Retry-After that the status endpoint gives for a job that is still processing
+STATUS_MAX_RETRY_AFTER = int(os.environ.get("STATUS_MAX_RETRY_AFTER", "300"))
 
 # Set up logging
 logging.basicConfig(
@@ -62,21 +91,45 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# the event history of a job is kept for late SSE subscribers until its result is gone
+result_store.add_removal_listener(job_events.discard)
+
+
+def finish_job(reference, status, ended, **event_data):
+    """Set the final status of a job in the registry, and publish it."""
+    with db_lock:
+        over_all_job_registry[reference]["status"] = status
+        over_all_job_registry[reference]["end_time"] = ended
+        if over_all_job_registry[reference]["start_time"]:
+            over_all_job_registry[reference]["duration"] = iso_duration(
+                over_all_job_registry[reference]["start_time"], ended
+            )
+    job_events.publish(reference, "job", dict(event_data, status=status))
+
+
 def run_job_queue():
     while True:
-        if not job_queue:
+        with db_lock:
+            job = job_queue.pop()
+        if job is None:
             logger.info("Job queue is empty. Waiting for tasks...")
             time.sleep(2)
             continue
 
-        job = job_queue.pop(0)
         reference = job["reference_number"]
         handler = JobStepHandler(job)
+        QUEUE_WAIT.observe(time.time() - job["queued_at"])
+        trace = job["trace"]
+        trace.add("queue-wait", job["queued_at"], time.time())
+        job_span = trace.start("job")
+        final = ("ERROR", now_utc(), {})
 
         try:
             with db_lock:
                 over_all_job_registry[reference]["status"] = "RUNNING"
                 over_all_job_registry[reference]["start_time"] = now_utc()
+                running_jobs.add(reference)
+            job_events.publish(reference, "job", {"status": "RUNNING"})
 
             steps = [
                 ("create-epub-no-img", handler.run_step_create_epub_no_img),
@@ -87,56 +140,82 @@ def run_job_queue():
             ]
 
             for step_name, step_fn in steps:
+                if job["cancelled"].is_set():
+                    # cancelled between two steps, or while it was being taken from the queue
+                    final = ("CANCELLED", now_utc(), {"cancelled_step": step_name})
+                    break
+
                 started = now_utc()
                 with db_lock:
                     over_all_job_registry[reference]["steps"][step_name]["status"] = "RUNNING"
                     over_all_job_registry[reference]["steps"][step_name]["start_time"] = started
+                job_events.publish(reference, "step", {
+                    "step": step_name, "status": "RUNNING", "start_time": started})
 
+                step_timer = time.monotonic()
+                step_span = trace.start(step_name, "step")
                 try:
                     success = step_fn()
                 except Exception as e:
                     logger.exception(
                         f"Step '{step_name}' failed with exception")
                     success = False
+                cancelled = job["cancelled"].is_set()
+                step_status = "SUCCESS" if success else (
+                    "CANCELLED" if cancelled else "ERROR")
+                trace.finish(step_span, status=step_status)
+                step_seconds = time.monotonic() - step_timer
+                STEP_DURATION.observe(step_seconds, step=step_name, status=step_status)
+                if success:
+                    step_durations.record(step_name, step_seconds, job["size"])
 
                 ended = now_utc()
                 with db_lock:
                     step = over_all_job_registry[reference]["steps"][step_name]
                     step["end_time"] = ended
                     step["duration"] = iso_duration(started, ended)
-                    step["status"] = "SUCCESS" if success else "ERROR"
+                    step["status"] = step_status
+                    if step_name in job.get("outputs", {}):
+                        step["output_dir"] = job["outputs"][step_name]
+                    step_event = dict(step, step=step_name)
+                job_events.publish(reference, "step", step_event)
 
+                if cancelled:
+                    final = ("CANCELLED", ended, {"cancelled_step": step_name})
+                    break
                 if not success:
-                    with db_lock:
-                        over_all_job_registry[reference]["status"] = "ERROR"
-                        over_all_job_registry[reference]["end_time"] = ended
-                        over_all_job_registry[reference]["duration"] = iso_duration(
-                            over_all_job_registry[reference]["start_time"], ended
-                        )
+                    final = ("ERROR", ended, {"failed_step": step_name})
                     break
             else:
-                end_time = now_utc()
-                with db_lock:
-                    over_all_job_registry[reference]["status"] = "SUCCESS"
-                    over_all_job_registry[reference]["end_time"] = end_time
-                    over_all_job_registry[reference]["duration"] = iso_duration(
-                        over_all_job_registry[reference]["start_time"], end_time
-                    )
+                final = ("SUCCESS", now_utc(), {})
 
         except Exception as e:
             logger.exception(
                 f"Unexpected error in run_job_queue for job {reference}")
+            final = ("ERROR", now_utc(), {})
+        finally:
+            status, ended, event_data = final
+            trace.finish(job_span, status=status)
+            # the result is stored before the final status is set, so that a finished job always has its result
+            store_job_results(reference, job, status)
+            finish_job(reference, status, ended, **event_data)
             with db_lock:
-                over_all_job_registry[reference]["status"] = "ERROR"
-                over_all_job_registry[reference]["end_time"] = now_utc()
+                running_jobs.discard(reference)
+            JOBS_FINISHED.inc(status=status)
+            trace.close()
+            job_queue.done(job)
 # https://fastapi.tiangolo.com/advanced/events/
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Starting background job thread via lifespan...")
-    thread = threading.Thread(target=run_job_queue, daemon=True)
-    thread.start()
+    for _ in range(JOB_WORKERS):
+        thread = threading.Thread(target=run_job_queue, daemon=True)
+        thread.start()
+    threading.Thread(target=job_workspaces.run_sweeper, daemon=True).start()
+    threading.Thread(target=result_store.run_evictor, daemon=True).start()
+    threading.Thread(target=engine_monitor.run_monitor, daemon=True).start()
     yield  # This allows FastAPI to start serving
     logger.info("App is shutting down...")  # Optional cleanup
 
@@ -150,6 +229,7 @@ print("SAXON_JAR:", SAXON_JAR)
 print("XSLT_DIR:", XSLT_DIR)
 pip_job_registry = {}
 over_all_job_registry = {}
+batch_registry = {}
 
 
 class InMemoryLogHandler(logging.Handler):
@@ -218,83 +298,739 @@ def prepare_final_output(job, job_status, result_zip_path):
     return final_zip_path
 
 
-def check_status_internal(reference_number: str) -> Union[dict, FileResponse]:
+def write_job_results(zipf, job_log, step_outputs, prefix=""):
+    """Writes the job log and the results of each remote step into an open zip file."""
+    zipf.writestr(prefix + "logs.txt", job_log)
+    for step_name, output_dir in step_outputs.items():
+        if not output_dir or not os.path.isdir(output_dir):
+            continue
+        for root, _, files in os.walk(output_dir):
+            for file in files:
+                file_path = os.path.join(root, file)
+                arcname = prefix + os.path.join(
+                    step_name, os.path.relpath(file_path, output_dir))
+                zipf.write(file_path, arcname)
+
+
+def store_job_results(reference, job, status):
+    """
+    Packages the log and the step results of a finished job into the result store,
+    and removes the workspace of the job. `status` is the final status of the job.
+    """
+    workspace = job.get("workspace")
+    trace = job["trace"]
+    packaging_span = trace.start("packaging")
+    # the job's own reference; the unpacked EPUB is removed when no step uses it any more
+    job["artifacts"].release()
     with db_lock:
-        entry = pip_job_registry.get(reference_number)
+        step_outputs = {name: step.get("output_dir")
+                        for name, step in over_all_job_registry[reference]["steps"].items()}
+    try:
+        final_zip_path = workspace.mkstemp(
+            suffix=".zip") if workspace else tempfile.mkstemp(suffix=".zip")[1]
+        with zipfile.ZipFile(final_zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+            write_job_results(
+                zipf, job["log_handler"].get_logs(), step_outputs)
+            # the packaging itself can't be part of the trace in the zip, so it ends here
+            trace.finish(packaging_span)
+            zipf.writestr("trace.json", json.dumps(trace.to_chrome()))
+        result_store.put(reference, final_zip_path, status)
+        job_workspaces.remove(reference)
+    except Exception:
+        logger.exception(f"Could not store the results for job {reference}")
+        # keep the results of the remote steps until the workspace expires
+        job_workspaces.finish(reference)
+    trace.finish(packaging_span)
 
-    if not entry:
-        return {
-            "status": "not_found",
-            "message": "No job found for filename",
-            "code": 404
-        }
 
-    status = entry.get("status")
-    final_zip = entry.get("final_zip")
+def check_status_internal(reference_number: str) -> Union[dict, FileResponse]:
+    with db_lock:
+        entry = over_all_job_registry.get(reference_number)
+        status = entry.get("status") if entry else None
 
     if status in ("QUEUED", "RUNNING", "IDLE"):
-        return {
+        return dict({
             "status": status,
             "message": "Job is still processing",
             "code": 202
+        }, **(estimate_job(reference_number) or {}))
+
+    # the result store survives restarts, so it may know about jobs that the registry doesn't
+    stored = result_store.entry(reference_number)
+    final_zip = result_store.get(reference_number)
+
+    if not entry and not stored:
+        return {
+            "status": "not_found",
+            "message": "No job found for filename",
+            "code": 404
         }
 
-    if not final_zip or not os.path.exists(final_zip):
+    if not final_zip:
         return {
-            "status": status,
+            "status": status or stored["status"],
             "message": "Result ZIP not found",
-            "code": 500
+            "code": 410 if status else 500
         }
     return FileResponse(
         path=final_zip,
         media_type="application/zip",
-        filename=os.path.basename(final_zip)
+        filename=f"{reference_number}_final.zip",
+        headers={"X-Job-Status": status or stored["status"]}
     )
 
 
-@app.post("/validate_nordic_epub/")
-async def submit_pipeline_job(epub: UploadFile = File(...),
-                              source: Optional[str] = Form(default="unknown")):
-
-    # reference = generate_reference_number(epub.filename, source)
-    # log_handler = InMemoryLogHandler()
-
-    log_handler = InMemoryLogHandler()
-    log_handler.setFormatter(logging.Formatter(
-        "%(asctime)s - %(levelname)s - %(message)s"))
-    logger.addHandler(log_handler)
-    logger.info("New job submission request received.")
-    temp_dir = tempfile.mkdtemp()
-    epub_path = os.path.join(temp_dir, epub.filename)
-    with open(epub_path, "wb") as f:
-        f.write(await epub.read())
-    logger.info(f"Uploaded file saved: {epub.filename}")
-
-    logger.info(
-        f"Job added to queue: {epub.filename} from source: {source} (position)")
-    production_number = os.path.splitext(epub.filename)[0]
-    reference_number = f"{production_number}_{source}_{uuid.uuid4().hex[:6]}"
-
+def enqueue_job(reference_number, epub_path, filename, source, log_handler, batch_id=None, trace=None, artifacts=None):
+    """Registers a job for an uploaded EPUB and appends it to the job queue."""
+    trace = trace or Trace(reference_number)
+    workspace = job_workspaces.create(reference_number)
+    artifacts = artifacts or JobArtifacts(epub_path, workspace.path)
     job_data = {
         "reference_number": reference_number,
         "epub_path": epub_path,
-        "filename": epub.filename,
+        "size": os.path.getsize(epub_path),
+        "filename": filename,
         "source": source,
         "log_handler": log_handler,
+        "batch_id": batch_id,
+        "workspace": workspace,
+        "artifacts": artifacts,
+        "queued_at": time.time(),
+        "trace": trace,
+        "cancelled": threading.Event(),
     }
 
     with db_lock:
         over_all_job_registry[reference_number] = {
             "status": "QUEUED",
+            "filename": filename,
+            "source": source,
+            "batch_id": batch_id,
+            "size": job_data["size"],
+            "trace": trace,
+            "cancelled": job_data["cancelled"],
             "start_time": None,
             "end_time": None,
             "duration": None,
-            "steps": {
-                "create-epub-no-img": {"status": "PENDING"},
-                "incoming-nordic": {"status": "PENDING"},
-                "nordic-epub3-to-html": {"status": "PENDING"},
-            }
+            "steps": {step: {"status": "PENDING"} for step in JOB_STEPS}
         }
         job_queue.append(job_data)
+    job_events.publish(reference_number, "job", {"status": "QUEUED"})
+    JOBS_SUBMITTED.inc()
+    UPLOAD_BYTES.inc(job_data["size"])
+
+    return reference_number
+
+
+def remaining_job_seconds(entry, now):
+    """Estimated seconds until a running job has finished, from the step it is in. Call with db_lock held."""
+    for index, step_name in enumerate(JOB_STEPS):
+        step = entry["steps"][step_name]
+        if step["status"] == "RUNNING":
+            elapsed = (now - datetime.fromisoformat(step["start_time"])).total_seconds()
+            return step_durations.remaining_seconds(JOB_STEPS[index:], elapsed, entry["size"])
+        if step["status"] == "PENDING":
+            return step_durations.job_seconds(JOB_STEPS[index:], entry["size"])
+    return 0.0
+
+
+def worker_free_times(now):
+    """Seconds until each worker is free to take a new job. Call with db_lock held."""
+    free_at = [remaining_job_seconds(over_all_job_registry[reference], now) for reference in running_jobs]
+    return free_at + [0.0] * max(0, JOB_WORKERS - len(free_at))
+
+
+def estimate_wait():
+    """
+    Estimates how long a job submitted now waits before it starts, from the historical step
+    durations: the running jobs finish, and the queued jobs are given to the workers in turn.
+    Returns (seconds until the new job starts, seconds until the first worker is free, queued jobs).
+    """
+    with db_lock:
+        queued = len(job_queue)
+        free_at = worker_free_times(datetime.utcnow())
+    return start_after(free_at, queued, step_durations.job_seconds(JOB_STEPS)), min(free_at), queued
+
+
+def estimate_job(reference_number):
+    """
+    Where a queued or running job is, and when it is expected to start and finish.
+    Returns None for jobs that are neither queued nor running.
+    """
+    now = datetime.utcnow()
+    with db_lock:
+        entry = over_all_job_registry.get(reference_number)
+        if not entry or entry["status"] not in ("QUEUED", "RUNNING"):
+            return None
+        if entry["status"] == "RUNNING":
+            remaining = remaining_job_seconds(entry, now)
+            return {
+                "estimated_seconds_remaining": math.ceil(remaining),
+                "estimated_finish": estimated_start(remaining),
+            }
+        position = job_queue.position(reference_number)
+        free_at = worker_free_times(now)
+        size = entry["size"]
+    if position is None:
+        # taken from the queue, but not started yet
+        position = {"position": 1, "source_position": 1}
+    wait = start_after(free_at, position["position"] - 1, step_durations.job_seconds(JOB_STEPS))
+    remaining = wait + step_durations.job_seconds(JOB_STEPS, size)
+    return dict(position,
+                estimated_wait_seconds=math.ceil(wait),
+                estimated_start=estimated_start(wait),
+                estimated_seconds_remaining=math.ceil(remaining),
+                estimated_finish=estimated_start(remaining))
+
+
+def refuse_if_out_of_capacity(jobs=1):
+    """
+    Refuses new jobs with 429 and a Retry-After header when the spool disk is full, or the
+    backlog is over the admission limits. Returns the estimated wait in seconds otherwise.
+    """
+    wait, first_free, queued = estimate_wait()
+    job_seconds = step_durations.job_seconds(JOB_STEPS)
+    has_capacity, reason = job_workspaces.has_capacity()
+    if not has_capacity:
+        # the disk is freed when a running job finishes and its results are packaged
+        retry_after = first_free or job_seconds
+    elif ADMISSION_MAX_QUEUE and queued + jobs > ADMISSION_MAX_QUEUE:
+        reason = "The queue has {} jobs, {} more would be over the limit of {}".format(
+            queued, jobs, ADMISSION_MAX_QUEUE)
+        retry_after = (queued + jobs - ADMISSION_MAX_QUEUE) * job_seconds / JOB_WORKERS
+    elif ADMISSION_MAX_WAIT and wait > ADMISSION_MAX_WAIT:
+        reason = "The estimated wait is {} seconds, the limit is {}".format(math.ceil(wait), ADMISSION_MAX_WAIT)
+        retry_after = wait - ADMISSION_MAX_WAIT
+    else:
+        return wait
+
+    logger.warning(f"Refusing new jobs: {reason}")
+    raise HTTPException(status_code=429, detail={
+        "reason": reason,
+        "estimated_wait_seconds": math.ceil(wait),
+        "estimated_start": estimated_start(wait),
+    }, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+def estimated_start(wait):
+    return (datetime.utcnow() + timedelta(seconds=wait)).isoformat()
+
+
+# a plain function, so that FastAPI runs the upload and pre-validation in its thread pool
+@app.post("/validate_nordic_epub/")
+def submit_pipeline_job(epub: UploadFile = File(...),
+                              source: Optional[str] = Form(default="unknown")):
+
+    # reference = generate_reference_number(epub.filename, source)
+    # log_handler = InMemoryLogHandler()
+
+    log_handler = InMemoryLogHandler()
+    log_handler.setFormatter(logging.Formatter(
+        "%(asctime)s - %(levelname)s - %(message)s"))
+    logger.addHandler(log_handler)
+    # the handler only collects this thread's records, and the thread goes back to the pool afterwards
+    try:
+        logger.info("New job submission request received.")
+        wait = refuse_if_out_of_capacity()
+        production_number = safe_name(os.path.splitext(os.path.basename(epub.filename or ""))[0])
+        reference_number = generate_reference_number(production_number, source)
+        trace = Trace(reference_number)
+        workspace = job_workspaces.create(reference_number)
+        queued = False
+        try:
+            temp_dir = workspace.mkdtemp("upload-")
+            epub_path = os.path.join(temp_dir, production_number + ".epub")
+            with trace.span("submit", filename=epub.filename, source=source):
+                with trace.span("upload"):
+                    with open(epub_path, "wb") as f:
+                        shutil.copyfileobj(epub.file, f)
+                logger.info(f"Uploaded file saved: {epub.filename}")
+
+                artifacts = JobArtifacts(epub_path, workspace.path)
+                with trace.span("pre-validation"):
+                    pre_validation = pre_validate_epub(epub_path, artifacts)
+            if pre_validation["status"] == "error":
+                logger.error(
+                    f"Pre-validation failed for {epub.filename}, the job is not queued")
+                return JSONResponse({
+                    "status": "REJECTED",
+                    "filename": epub.filename,
+                    "errors": pre_validation["errors"],
+                    "warnings": pre_validation["warnings"]
+                }, status_code=422)
+
+            enqueue_job(reference_number, epub_path,
+                        epub.filename, source, log_handler, trace=trace, artifacts=artifacts)
+            queued = True
+        finally:
+            # a rejected or failed submission leaves nothing behind
+            if not queued:
+                job_workspaces.remove(reference_number)
+
+        # a worker may have taken the job already
+        estimate = estimate_job(reference_number) or {
+            "estimated_wait_seconds": math.ceil(wait), "estimated_start": estimated_start(wait)}
+        logger.info(
+            f"Job added to queue: {epub.filename} from source: {source} (position {estimate.get('position', 1)})")
+
+        return JSONResponse(dict(estimate, status="QUEUED", reference_number=reference_number), status_code=202)
+    finally:
+        logger.removeHandler(log_handler)
+
+
+def is_epub_upload(path):
+    """An EPUB is a zip file too, so look at the mimetype entry instead of the file extension."""
+    try:
+        with zipfile.ZipFile(path, "r") as archive:
+            if "mimetype" not in archive.namelist():
+                return False
+            return archive.read("mimetype").startswith(b"application/epub+zip")
+    except ZIP_ERRORS:
+        return False
+
+
+def extract_epubs_from_zip(zip_path, target_dir):
+    """
+    Extracts the *.epub entries of a zip of EPUBs, flattening any folders in the zip.
+    Raises UnsafeArchiveError if the zip is over the extraction limits.
+    """
+    epub_paths = []
+    with zipfile.ZipFile(zip_path, "r") as archive:
+        problems = Filesystem.check_zip_limits(archive.infolist())
+        if problems:
+            raise UnsafeArchiveError("; ".join(problems))
+        for info in archive.infolist():
+            filename = os.path.basename(info.filename)
+            if info.is_dir() or not filename.lower().endswith(".epub") or filename.startswith("._"):
+                continue
+            epub_path = os.path.join(target_dir, filename)
+            if os.path.exists(epub_path):
+                # same filename in different folders of the zip
+                epub_path = os.path.join(
+                    tempfile.mkdtemp(dir=target_dir), filename)
+            with archive.open(info) as source_file, open(epub_path, "wb") as target_file:
+                shutil.copyfileobj(source_file, target_file)
+            epub_paths.append(epub_path)
+    return epub_paths
+
+
+# a plain function, so that FastAPI runs the uploads, unzipping and pre-validation in its thread pool
+@app.post("/validate_nordic_epub/batch/")
+def submit_pipeline_batch(epubs: List[UploadFile] = File(...),
+                                source: Optional[str] = Form(default="unknown")):
+    """
+    Accepts several EPUBs, or zip files containing EPUBs, and queues them all
+    with one shared batch ID.
+    """
+    wait = refuse_if_out_of_capacity(len(epubs))
+    batch_id = f"batch_{safe_name(source)}_{uuid.uuid4().hex[:8]}"
+    logger.info(f"New batch submission request received: {batch_id}")
+
+    # the uploads are unpacked in a workspace for the batch, and each EPUB is then moved to the workspace of its job
+    batch_workspace = job_workspaces.create(batch_id)
+    try:
+        epub_paths = []
+        for upload in epubs:
+            temp_dir = batch_workspace.mkdtemp("upload-")
+            name, extension = os.path.splitext(os.path.basename(upload.filename or ""))
+            upload_path = os.path.join(
+                temp_dir, safe_name(name) + "." + safe_name(extension[1:], "epub"))
+            with open(upload_path, "wb") as f:
+                shutil.copyfileobj(upload.file, f)
+
+            if is_epub_upload(upload_path):
+                epub_paths.append(upload_path)
+            elif zipfile.is_zipfile(upload_path):
+                try:
+                    extracted = extract_epubs_from_zip(upload_path, temp_dir)
+                except UnsafeArchiveError as e:
+                    logger.warning(f"Refusing {upload.filename}: {e}")
+                    raise HTTPException(
+                        status_code=400, detail=f"{upload.filename}: {e}")
+                os.remove(upload_path)
+                logger.info(
+                    f"Extracted {len(extracted)} EPUBs from {upload.filename}")
+                epub_paths.extend(extracted)
+            else:
+                logger.warning(
+                    f"Skipping {upload.filename}: neither an EPUB nor a zip of EPUBs")
+
+        if not epub_paths:
+            raise HTTPException(
+                status_code=400, detail="No EPUB files found in the submission")
+
+        # zips of EPUBs give more jobs than there were uploads, so admit the batch again with the real count
+        wait = refuse_if_out_of_capacity(len(epub_paths))
+
+        references = []
+        rejected = {}
+        for epub_path in epub_paths:
+            filename = os.path.basename(epub_path)
+            reference_number = generate_reference_number(
+                os.path.splitext(filename)[0], source)
+            workspace = job_workspaces.create(reference_number)
+            try:
+                job_epub_path = os.path.join(workspace.mkdtemp("upload-"), filename)
+                os.replace(epub_path, job_epub_path)
+                # unpacked once, for pre-validation and the steps of the job
+                artifacts = JobArtifacts(job_epub_path, workspace.path)
+                pre_validation = pre_validate_epub(job_epub_path, artifacts)
+            except Exception:
+                job_workspaces.remove(reference_number)
+                raise
+            if pre_validation["status"] == "error":
+                rejected[filename] = pre_validation["errors"]
+                artifacts.release()
+                job_workspaces.remove(reference_number)
+                continue
+
+            log_handler = InMemoryLogHandler()
+            log_handler.setFormatter(logging.Formatter(
+                "%(asctime)s - %(levelname)s - %(message)s"))
+            logger.addHandler(log_handler)
+            try:
+                logger.info(
+                    f"Job added to queue: {filename} from source: {source} (batch: {batch_id})")
+                enqueue_job(reference_number, job_epub_path, filename,
+                            source, log_handler, batch_id=batch_id, artifacts=artifacts)
+            except Exception:
+                job_workspaces.remove(reference_number)
+                raise
+            finally:
+                logger.removeHandler(log_handler)
+            references.append(reference_number)
+    finally:
+        job_workspaces.remove(batch_id)
+
+    with db_lock:
+        batch_registry[batch_id] = {
+            "source": source,
+            "created": now_utc(),
+            "references": references,
+            "rejected": rejected,
+        }
+
+    return JSONResponse({
+        "status": "QUEUED" if references else "REJECTED",
+        "batch_id": batch_id,
+        "reference_numbers": references,
+        "rejected": rejected,
+        "estimated_wait_seconds": math.ceil(wait),
+        "estimated_start": estimated_start(wait),
+    }, status_code=202 if references else 422)
+
+
+def batch_status_internal(batch_id):
+    with db_lock:
+        batch = batch_registry.get(batch_id)
+        if not batch:
+            return None
+        jobs = {reference: {
+            "filename": over_all_job_registry[reference].get("filename"),
+            "status": over_all_job_registry[reference]["status"],
+            "duration": over_all_job_registry[reference]["duration"],
+            "steps": {name: step["status"] for name, step in over_all_job_registry[reference]["steps"].items()},
+        } for reference in batch["references"]}
+
+    for reference, job in jobs.items():
+        if job["status"] in ("QUEUED", "RUNNING"):
+            job.update(estimate_job(reference) or {})
+
+    counts = {}
+    for job in jobs.values():
+        counts[job["status"]] = counts.get(job["status"], 0) + 1
+    finished = sum(counts.get(status, 0) for status in FINAL_STATUSES)
+
+    return {
+        "batch_id": batch_id,
+        "source": batch["source"],
+        "created": batch["created"],
+        "status": "DONE" if finished == len(jobs) else "PROCESSING",
+        "total": len(jobs),
+        "cancelled": counts.get("CANCELLED", 0),
+        "counts": counts,
+        "jobs": jobs,
+        "rejected": batch["rejected"],
+    }
+
+
+def cancel_job(reference_number):
+    """
+    Cancel a job. A queued job is taken out of the queue and finished right away. A running
+    job is stopped by the worker: the remote Pipeline 2 job is deleted, and local migrator
+    runs are stopped. Returns (status, code), or None if there is no such job.
+    """
+    with db_lock:
+        entry = over_all_job_registry.get(reference_number)
+        if not entry:
+            return None
+        if entry["status"] in FINAL_STATUSES:
+            return entry["status"], 409
+        entry["cancelled"].set()
+        queued = job_queue.get(reference_number)
+        if queued:
+            job_queue.remove(queued)
+
+    migrator_pool.cancel(reference_number)
+    if not queued:
+        logger.info(f"Cancelling running job {reference_number}")
+        return "CANCELLING", 202
+
+    logger.info(f"Cancelled queued job {reference_number}")
+    store_job_results(reference_number, queued, "CANCELLED")
+    finish_job(reference_number, "CANCELLED", now_utc())
+    JOBS_FINISHED.inc(status="CANCELLED")
+    queued["trace"].close()
+    return "CANCELLED", 200
+
+
+@app.delete("/jobs/{reference_number}")
+def delete_job(reference_number: str):
+    result = cancel_job(reference_number)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    status, code = result
+    message = {
+        200: "Job is cancelled",
+        202: "Job is being cancelled",
+        409: "Job is already finished",
+    }[code]
+    return JSONResponse({"reference_number": reference_number, "status": status, "message": message},
+                        status_code=code)
+
+
+@app.delete("/batches/{batch_id}")
+def delete_batch(batch_id: str):
+    """Cancel all the unfinished jobs of a batch."""
+    with db_lock:
+        batch = batch_registry.get(batch_id)
+        references = list(batch["references"]) if batch else None
+    if references is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    jobs = {}
+    for reference in references:
+        result = cancel_job(reference)
+        if result:
+            jobs[reference] = result[0]
+    return JSONResponse({"batch_id": batch_id, "jobs": jobs})
+
+
+@app.get("/batches/{batch_id}")
+async def check_batch_status(batch_id: str):
+    status = batch_status_internal(batch_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return JSONResponse(status)
+
+
+def remove_dir(path: str):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+@app.get("/batches/{batch_id}/download")
+async def download_batch_results(batch_id: str, background_tasks: BackgroundTasks):
+    """
+    Returns one zip with a folder per job, containing the final result of each job
+    from the result store. Only available when every job in the batch is done.
+    """
+    status = batch_status_internal(batch_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    if status["status"] != "DONE":
+        return JSONResponse({
+            "status": status["status"],
+            "message": "Batch is still processing",
+            "counts": status["counts"]
+        }, status_code=202)
+
+    temp_dir = tempfile.mkdtemp()
+    batch_zip_path = os.path.join(temp_dir, f"{batch_id}.zip")
+    with zipfile.ZipFile(batch_zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+        zipf.writestr("batch.json", json.dumps(status, indent=2))
+        for reference in status["jobs"]:
+            final_zip = result_store.get(reference)
+            if not final_zip:
+                continue
+            # copy the entries of the final zip of each job into a folder for the job
+            with zipfile.ZipFile(final_zip, "r") as job_zip:
+                for info in job_zip.infolist():
+                    with job_zip.open(info) as source, zipf.open(f"{reference}/{info.filename}", "w") as target:
+                        shutil.copyfileobj(source, target)
+
+    background_tasks.add_task(remove_dir, temp_dir)
+    return FileResponse(
+        path=batch_zip_path,
+        media_type="application/zip",
+        filename=os.path.basename(batch_zip_path)
+    )
+
+
+QUEUE_DEPTH = Gauge("nordic_to_bok_queue_depth",
+                    "Jobs waiting in the job queue", function=lambda: len(job_queue))
+
+
+class SourceSchedule(BaseModel):
+    weight: Optional[int] = None
+    max_running: Optional[int] = None
+    rate_per_minute: Optional[float] = None
+
+
+@app.get("/scheduler")
+async def get_scheduler():
+    wait, _, queued = estimate_wait()
+    return JSONResponse(dict(job_queue.status(), workers=JOB_WORKERS, admission={
+        "max_queue": ADMISSION_MAX_QUEUE,
+        "max_wait_seconds": ADMISSION_MAX_WAIT,
+        "estimated_wait_seconds": math.ceil(wait),
+        "step_durations": step_durations.status(),
+    }))
+
+
+@app.put("/scheduler/sources/{source}")
+async def configure_source(source: str, schedule: SourceSchedule):
+    """Change the weight, concurrency cap or rate limit of a source. Fields that are left out are unchanged."""
+    changes = {key: value for key, value in schedule.dict().items()
+               if value is not None}
+    try:
+        config = job_queue.configure(source, **changes)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return JSONResponse({"source": source, **config.as_dict()})
+
+
+@app.get("/job-queue")
+async def list_job_queue():
+    with db_lock:
+        queued = [job["reference_number"] for job in job_queue]
+        running = list(running_jobs)
+        entries = {reference: over_all_job_registry[reference] for reference in queued + running}
+
+    def describe(reference):
+        entry = entries[reference]
+        return dict({"reference_number": reference, "filename": entry["filename"], "source": entry["source"],
+                     "size": entry["size"], "start_time": entry["start_time"]},
+                    **(estimate_job(reference) or {}))
+
+    queued = sorted((describe(reference) for reference in queued),
+                    key=lambda job: job.get("position", 0))
+    return JSONResponse({"queued": queued, "running": [describe(reference) for reference in running]})
+
+
+@app.get("/health", tags=["Health"])
+async def health_check(refresh: bool = False):
+    """
+    Reports the engines from the last check of the health monitor. With refresh=true all
+    engines are checked again first, at the same time.
+    """
+    if refresh:
+        await asyncio.to_thread(engine_monitor.check_all)
+    return JSONResponse({
+        "status": "ok",  # reflects internal health only
+        "internal": "ok",
+        "external": engine_monitor.report(),
+        "engines": engine_monitor.status(),
+    })
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/download/{reference_number}")
+async def download_result_zip(reference_number: str):
+    final_zip = result_store.get(reference_number)
+
+    if not final_zip:
+        return JSONResponse({"error": "Result zip not found"}, status_code=404)
+
+    return FileResponse(
+        path=final_zip,
+        media_type="application/zip",
+        filename=f"{reference_number}_final.zip"
+    )
+
+
+@app.get("/checkstatus/{reference_number}")
+async def check_status(reference_number: str):
+    result = check_status_internal(reference_number)
+
+    # If result is a FileResponse, return it directly
+    if isinstance(result, FileResponse):
+        return result
+
+    # Otherwise, extract response content and status code
+    content = {}
+    for key, value in result.items():
+        if key != "code":
+            content[key] = value
+
+    status_code = result.get("code", 200)
+    headers = None
+    if "estimated_seconds_remaining" in content:
+        # tells the client when to check back
+        headers = {"Retry-After": str(min(STATUS_MAX_RETRY_AFTER, max(1, content["estimated_seconds_remaining"])))}
+    return JSONResponse(content=content, status_code=status_code, headers=headers)
+
+
+def format_sse(entry):
+    return f"id: {entry['id']}\nevent: {entry['event']}\ndata: {json.dumps(entry['data'])}\n\n"
+
+
+@app.get("/jobs/{reference_number}/events")
+async def stream_job_events(reference_number: str, request: Request):
+    """
+    Server-sent events stream of step transitions and remote status changes.
+    The stream replays the history of the job first, and ends when the job is done.
+    """
+    with db_lock:
+        if reference_number not in over_all_job_registry:
+            raise HTTPException(status_code=404, detail="Job not found")
+
+    last_event_id = request.headers.get("last-event-id")
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else -1
+
+    async def event_stream():
+        history, queue = job_events.subscribe(reference_number)
+        try:
+            for entry in history:
+                if entry["id"] <= last_event_id:
+                    continue
+                yield format_sse(entry)
+                if job_events.is_final(entry):
+                    return
+
+            while not await request.is_disconnected():
+                try:
+                    entry = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(entry)
+                if job_events.is_final(entry):
+                    return
+        finally:
+            job_events.unsubscribe(reference_number, queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/jobs/{reference_number}/trace")
+async def get_job_trace(reference_number: str):
+    """
+    The timeline of a job in the Chrome trace-event format (open it in chrome://tracing or Perfetto).
+    Running jobs return the spans so far; finished jobs also have the trace in their result zip.
+    """
+    with db_lock:
+        entry = over_all_job_registry.get(reference_number)
+        trace = entry.get("trace") if entry else None
+    if trace:
+        return JSONResponse(trace.to_chrome())
 
-    return JSONResponse({"status": "QUEUED", "reference_number": reference_number}, status_code=202)
+    final_zip = result_store.get(reference_number)
+    if final_zip:
+        with zipfile.ZipFile(final_zip, "r") as zipf:
+            if "trace.json" in zipf.namelist():
+                return JSONResponse(json.loads(zipf.read("trace.json")))
+    raise HTTPException(status_code=404, detail="No trace found for job")
@@ -0,0 +1,149 @@
+import math
+import threading
+
+
+class Metric:
+    """A metric in the Prometheus text exposition format, with optional labels given as keyword arguments."""
+
+    metric_type = None
+
+    def __init__(self, name, documentation, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        self.values = {}
+        (registry or REGISTRY).register(self)
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def _format_labels(key, extra=()):
+        labels = list(key) + list(extra)
+        if not labels:
+            return ""
+        escaped = ['{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                   for name, value in labels]
+        return "{" + ",".join(escaped) + "}"
+
+    @staticmethod
+    def _format_value(value):
+        if value == math.inf:
+            return "+Inf"
+        return repr(float(value))
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.metric_type)]
+        for name, key, value in self.samples():
+            lines.append("{}{} {}".format(
+                name, Metric._format_labels(key), Metric._format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = Metric._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(Metric._key(labels), 0)
+
+
+class Gauge(Metric):
+    """A gauge that is either set explicitly, or read from `function` when the metrics are collected."""
+
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, function=None, registry=None):
+        super().__init__(name, documentation, registry)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[Metric._key(labels)] = value
+
+    def samples(self):
+        if self.function:
+            return [(self.name, (), self.function())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    default_buckets = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self, name, documentation, buckets=default_buckets, registry=None):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, registry)
+
+    def observe(self, value, **labels):
+        key = Metric._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["buckets"][i] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, entry in self.values.items():
+                for bound, count in zip(self.buckets, entry["buckets"]):
+                    samples.append((self.name + "_bucket", key + (("le", Metric._format_value(bound)),), count))
+                samples.append((self.name + "_sum", key, entry["sum"]))
+                samples.append((self.name + "_count", key, entry["count"]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# The metrics of the service. Instrumented code imports the metrics it updates from here.
+
+JOBS_SUBMITTED = Counter("nordic_to_bok_jobs_submitted_total",
+                         "Jobs accepted into the job queue")
+JOBS_FINISHED = Counter("nordic_to_bok_jobs_finished_total",
+                        "Jobs that have finished, by final status")
+QUEUE_WAIT = Histogram("nordic_to_bok_queue_wait_seconds",
+                       "Time from submission until a job is taken from the queue")
+STEP_DURATION = Histogram("nordic_to_bok_step_duration_seconds",
+                          "Duration of each job step, by step and status")
+REMOTE_WAIT = Histogram("nordic_to_bok_remote_wait_seconds",
+                        "Time from posting a job to a Pipeline 2 engine until it is done, by engine and script")
+UPLOAD_BYTES = Counter("nordic_to_bok_upload_bytes_total",
+                       "Bytes of EPUBs uploaded by clients")
+REMOTE_UPLOAD_BYTES = Counter("nordic_to_bok_remote_upload_bytes_total",
+                              "Bytes of job data posted to Pipeline 2 engines, by engine")
+REMOTE_DOWNLOAD_BYTES = Counter("nordic_to_bok_remote_download_bytes_total",
+                                "Bytes of results downloaded from Pipeline 2 engines, by engine")
+CACHE_REQUESTS = Counter("nordic_to_bok_cache_requests_total",
+                         "Cache lookups, by cache and result (hit or miss)")
@@ -0,0 +1,121 @@
+import os
+import sys
+import logging
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from filesystem import Filesystem
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+MIGRATOR_WORKERS = int(os.environ.get("MIGRATOR_WORKERS", "2"))
+MIGRATOR_TIMEOUT = int(os.environ.get("MIGRATOR_TIMEOUT", "600"))
+MIGRATOR_TAIL_LINES = int(os.environ.get("MIGRATOR_TAIL_LINES", "200"))
+
+
+class MigratorRun:
+    """One run of the migrator: the command, whether it has started, and the outcome."""
+
+    def __init__(self, reference, args, cwd, log):
+        self.reference = reference
+        self.args = args
+        self.cwd = cwd
+        self.log = log
+        self.started = False
+        self.future = None
+        self.cancelled = threading.Event()
+        self.returncode = None
+        self.timed_out = False
+        self.tail = deque(maxlen=MIGRATOR_TAIL_LINES)
+
+    def result(self, timeout=None):
+        """Wait for the run to finish. Returns True if the migrator succeeded."""
+        return self.future.result(timeout)
+
+    def cancel(self):
+        self.cancelled.set()
+        self.future.cancel()
+
+
+class MigratorPool:
+    """
+    Runs the local migrator (src/run.py in EPUB_TO_HTML_HOME) in separate processes, with at
+    most `workers` running at the same time. The output is streamed line by line to the log
+    of the job with Filesystem.run_static_streaming, and only the last lines are kept for
+    error reports.
+
+    Runs are registered by job reference, so that they can be cancelled when a job is aborted.
+    A cancelled or timed out migrator is stopped together with its child processes.
+    """
+
+    def __init__(self, workers=MIGRATOR_WORKERS, timeout=MIGRATOR_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="migrator")
+        self.runs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, reference, args, cwd, log=None):
+        run = MigratorRun(reference, args, cwd, log or logger)
+        # the future is set before the run is registered, so that cancel() always has a future to cancel
+        run.future = self.executor.submit(self._run, run)
+        with self.lock:
+            self.runs.setdefault(reference, []).append(run)
+        # added after the run is registered, so that a run that has already finished is still forgotten
+        run.future.add_done_callback(lambda future: self._forget(run))
+        return run
+
+    def cancel(self, reference):
+        """Cancel the queued and running migrator runs of a job. Returns the number of runs cancelled."""
+        with self.lock:
+            runs = list(self.runs.get(reference, []))
+        for run in runs:
+            run.log.info(f"Stopper migreringen for {reference}")
+            run.cancel()
+        return len(runs)
+
+    def status(self):
+        with self.lock:
+            runs = [run for runs in self.runs.values() for run in runs]
+        return {
+            "workers": self.workers,
+            "running": sum(1 for run in runs if run.started),
+            "queued": sum(1 for run in runs if not run.started),
+        }
+
+    def _forget(self, run):
+        with self.lock:
+            runs = self.runs.get(run.reference, [])
+            if run in runs:
+                runs.remove(run)
+            if not runs:
+                self.runs.pop(run.reference, None)
+
+    def _run(self, run):
+        if run.cancelled.is_set():
+            return False
+        run.started = True
+        try:
+            process = Filesystem.run_static_streaming(run.args, run.cwd, run.log, timeout=self.timeout, check=False,
+                                                      stdout_level="INFO", stderr_level="WARNING",
+                                                      tail_lines=MIGRATOR_TAIL_LINES,
+                                                      line_callback=lambda stream, line: run.tail.append(line),
+                                                      cancel=run.cancelled)
+        except subprocess.TimeoutExpired:
+            run.timed_out = True
+            run.log.error("Migreringen tok for lang tid og ble derfor stoppet.")
+            return False
+        run.returncode = process.returncode
+        return run.returncode == 0 and not run.cancelled.is_set()
+
+
+migrator_pool = MigratorPool()
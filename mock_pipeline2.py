@@ -0,0 +1,231 @@
+"""
+A stand-in for the Pipeline 2 web service, for load testing the job path without real engines.
+
+It implements the parts of the web service API that RemoteDaisyPipelineJob uses. Jobs don't
+do any work: they finish after a configurable latency, and fail at a configurable rate. The
+result of a job is a zip with the files that were posted to it, and a small report.
+
+Run it, and point the app at it:
+
+    python mock_pipeline2.py --port 8181 --latency 20 --jitter 5 --failure-rate 0.05
+    REMOTE_PIPELINE2_WS_ENDPOINTS=http://localhost:8181/ws uvicorn main:app
+"""
+
+import io
+import sys
+import time
+import uuid
+import random
+import logging
+import zipfile
+import argparse
+import threading
+
+from fastapi import FastAPI, APIRouter, Request, HTTPException
+from fastapi.responses import Response
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+NAMESPACE = "http://www.daisy.org/ns/pipeline/data"
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+
+# the scripts that the app uses, with the script versions it looks for
+SCRIPTS = {
+    "nordic-epub3-validate": "1.3.0",
+    "nordic-epub3-to-html": "1.3.0",
+}
+
+
+class MockSettings:
+    """How the mock engine behaves. Changed from the command line."""
+
+    version = "1.11.1-SNAPSHOT"
+    latency = 10.0
+    jitter = 0.0
+    failure_rate = 0.0
+    http_error_rate = 0.0
+    prefix = "/ws"
+
+
+settings = MockSettings()
+jobs = {}
+jobs_lock = threading.Lock()
+
+app = FastAPI()
+router = APIRouter()
+
+
+def xml_response(body, status_code=200):
+    return Response(XML_DECLARATION + body, status_code=status_code, media_type="application/xml")
+
+
+def maybe_fail_request():
+    if random.random() < settings.http_error_rate:
+        raise HTTPException(status_code=503, detail="Simulated engine failure")
+
+
+def job_status(job):
+    if job["status"] in ("IDLE", "RUNNING") and time.time() >= job["finishes"]:
+        job["status"] = "ERROR" if job["fails"] else "DONE"
+    elif job["status"] == "IDLE":
+        job["status"] = "RUNNING"
+    return job["status"]
+
+
+def job_xml(job, base_url):
+    return ('<job xmlns="{ns}" id="{id}" href="{base}/jobs/{id}" status="{status}">'
+            '<script id="{script}" href="{base}/scripts/{script}"/>'
+            '<log href="{base}/jobs/{id}/log"/>'
+            '<results href="{base}/jobs/{id}/result" mime-type="application/zip"/>'
+            '</job>').format(ns=NAMESPACE, id=job["id"], base=base_url, status=job_status(job), script=job["script"])
+
+
+def base_url(request):
+    return str(request.base_url).rstrip("/") + settings.prefix
+
+
+@router.get("/alive")
+async def alive():
+    return xml_response('<alive xmlns="{}" authentication="false" mode="local" version="{}"/>'.format(
+        NAMESPACE, settings.version))
+
+
+@router.get("/scripts")
+async def list_scripts(request: Request):
+    maybe_fail_request()
+    scripts = "".join(
+        '<script id="{0}" href="{1}/scripts/{0}"><nicename>{0}</nicename><version>{2}</version></script>'.format(
+            script_id, base_url(request), version)
+        for script_id, version in SCRIPTS.items())
+    return xml_response('<scripts xmlns="{}" href="{}/scripts">{}</scripts>'.format(
+        NAMESPACE, base_url(request), scripts))
+
+
+@router.get("/scripts/{script_id}")
+async def get_script(script_id: str, request: Request):
+    maybe_fail_request()
+    if script_id not in SCRIPTS:
+        raise HTTPException(status_code=404, detail="No such script")
+    return xml_response(
+        '<script xmlns="{ns}" id="{id}" href="{base}/scripts/{id}">'
+        '<nicename>{id}</nicename><version>{version}</version>'
+        '<input name="epub" sequence="false" mediaType="application/epub+zip" required="true"/>'
+        '</script>'.format(ns=NAMESPACE, id=script_id, base=base_url(request), version=SCRIPTS[script_id]))
+
+
+@router.post("/jobs")
+async def create_job(request: Request):
+    maybe_fail_request()
+    form = await request.form()
+    if "job-request" not in form:
+        raise HTTPException(status_code=400, detail="Missing job-request")
+    job_request = await form["job-request"].read()
+    job_data = await form["job-data"].read() if "job-data" in form else None
+
+    script = "unknown"
+    for script_id in SCRIPTS:
+        if "/scripts/" + script_id in job_request.decode("utf-8"):
+            script = script_id
+
+    now = time.time()
+    job = {
+        "id": str(uuid.uuid4()),
+        "script": script,
+        "status": "IDLE",
+        "created": now,
+        "finishes": now + max(0.0, random.gauss(settings.latency, settings.jitter)),
+        "fails": random.random() < settings.failure_rate,
+        "data": job_data,
+    }
+    with jobs_lock:
+        jobs[job["id"]] = job
+    logger.info(f"Created job {job['id']} ({script}), finishes in {job['finishes'] - now:.1f} s")
+    return xml_response(job_xml(job, base_url(request)), status_code=201)
+
+
+def get_job_or_404(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="No such job")
+    return job
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str, request: Request):
+    maybe_fail_request()
+    return xml_response(job_xml(get_job_or_404(job_id), base_url(request)))
+
+
+@router.delete("/jobs/{job_id}")
+async def delete_job(job_id: str):
+    with jobs_lock:
+        job = jobs.pop(job_id, None)
+    if not job:
+        raise HTTPException(status_code=404, detail="No such job")
+    return Response(status_code=204)
+
+
+@router.get("/jobs/{job_id}/result")
+async def get_result(job_id: str):
+    maybe_fail_request()
+    job = get_job_or_404(job_id)
+    if job_status(job) not in ("DONE", "ERROR"):
+        raise HTTPException(status_code=404, detail="The job is not finished")
+
+    result = io.BytesIO()
+    with zipfile.ZipFile(result, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("report/report.html",
+                         "<html><body><p>{} {}</p></body></html>".format(job["script"], job["status"]))
+        if job["data"]:
+            with zipfile.ZipFile(io.BytesIO(job["data"])) as context:
+                for info in context.infolist():
+                    archive.writestr("output/" + info.filename, context.read(info))
+    return Response(result.getvalue(), media_type="application/zip")
+
+
+@router.get("/jobs/{job_id}/log")
+async def get_log(job_id: str):
+    job = get_job_or_404(job_id)
+    return Response("Mock Pipeline 2 job {} ({}): {}\n".format(job["id"], job["script"], job_status(job)),
+                    media_type="text/plain")
+
+
+app.include_router(router, prefix=settings.prefix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A mock Pipeline 2 web service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8181)
+    parser.add_argument("--prefix", default=settings.prefix, help="Path of the web service (default: /ws)")
+    parser.add_argument("--version", default=settings.version, help="Pipeline 2 version reported by /alive")
+    parser.add_argument("--latency", type=float, default=settings.latency, help="Mean job duration in seconds")
+    parser.add_argument("--jitter", type=float, default=settings.jitter, help="Standard deviation of the job duration")
+    parser.add_argument("--failure-rate", type=float, default=settings.failure_rate,
+                        help="Fraction of the jobs that end with status ERROR")
+    parser.add_argument("--http-error-rate", type=float, default=settings.http_error_rate,
+                        help="Fraction of the requests that fail with HTTP 503")
+    args = parser.parse_args()
+
+    settings.prefix = args.prefix
+    settings.version = args.version
+    settings.latency = args.latency
+    settings.jitter = args.jitter
+    settings.failure_rate = args.failure_rate
+    settings.http_error_rate = args.http_error_rate
+    if settings.prefix != MockSettings.prefix:
+        # the routes under the default prefix stay, so that `uvicorn mock_pipeline2:app` works without main()
+        app.include_router(router, prefix=settings.prefix)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
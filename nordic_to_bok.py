@@ -4,7 +4,6 @@ import io
 import sys
 import traceback
 from pathlib import Path
-import uuid
 import tempfile
 import shutil
 import subprocess
@@ -13,6 +12,7 @@ import json
 import threading
 import datetime
 import logging
+import asyncio
 import zipfile
 import xml.etree.ElementTree as ET
 from typing import Optional, Union
@@ -29,9 +29,11 @@ from fastapi import BackgroundTasks
 from dotenv import load_dotenv
 
 from daisy_pipeline_light import RemoteDaisyPipelineJob  # your simplified class
-from utils import remove_file  # your utility function
+from utils import remove_file, generate_reference_number, safe_name  # your utility function
 from incoming_nordic import create_epub_no_img  # your EPUB validation function
 from nordic_to_nlbpub import get_nordic_guidelines_version, nordic_to_nlbpub_with_migrator
+from job_workspace import JobArtifacts
+from engine_health import engine_monitor
 
 
 # Registry and queue
@@ -155,7 +157,29 @@ def check_status_internal(reference_number: str) -> Union[dict, FileResponse]:
     )
 
 
+def job_logger(reference_number, log_handler):
+    """
+    A logger that writes to the log of a job from any thread, like the threads that read the
+    migrator output. It isn't registered with logging, so it is freed with the job.
+    """
+    job_log = logging.Logger(f"{__name__}.{reference_number}")
+    job_log.parent = logger
+    handler = logging.StreamHandler(log_handler.log_stream)
+    handler.setFormatter(log_handler.formatter)
+    job_log.addHandler(handler)
+    return job_log
+
+
 def run_validation(epub_path, reference_number, filename, source, log_handler):
+    # the EPUB is unzipped once, next to the upload, and shared by the steps
+    artifacts = JobArtifacts(epub_path, os.path.dirname(epub_path), logger)
+    try:
+        validate_with_artifacts(epub_path, reference_number, filename, source, log_handler, artifacts)
+    finally:
+        artifacts.release()
+
+
+def validate_with_artifacts(epub_path, reference_number, filename, source, log_handler, artifacts):
     over_all_job_registry[reference_number] = {
         "status": "RUNNING",
         "start_time": datetime.datetime.utcnow().isoformat(),
@@ -169,7 +193,8 @@ def run_validation(epub_path, reference_number, filename, source, log_handler):
             "insert-metadata": "PENDING",
         }
     }
-    result = create_epub_no_img(epub_path)
+    with artifacts.use() as epub:
+        result = create_epub_no_img(epub_path, epub=epub)
     epub_noimages_file = result.get("file")
     print("Result from create_epub_no_img:", result)
 
@@ -245,14 +270,16 @@ def run_validation(epub_path, reference_number, filename, source, log_handler):
             over_all_job_registry[reference_number]["final_zip"] = final_zip
             logger.info(
                 f"Final zip for job {reference_number} is ready: {final_zip}")
-        guidelines = get_nordic_guidelines_version(epub_path)
-        if guidelines is False:
-            logger.error("Error: Could not determine guidelines version.")
-        elif guidelines == "2020-1":
-            logger.info("EPUB follows the 2020-1 Nordic guidelines.")
-            nordic_to_nlbpub_with_migrator(epub_path)
-        else:
-            logger.info("EPUB follows the 2015-1 Nordic guidelines.")
+        with artifacts.use() as epub:
+            guidelines = get_nordic_guidelines_version(epub.asDir())
+            if guidelines is False:
+                logger.error("Error: Could not determine guidelines version.")
+            elif guidelines == "2020-1":
+                logger.info("EPUB follows the 2020-1 Nordic guidelines.")
+                nordic_to_nlbpub_with_migrator(
+                    epub_path, reference_number, job_logger(reference_number, log_handler), epub)
+            else:
+                logger.info("EPUB follows the 2015-1 Nordic guidelines.")
     elif status == "ERROR":
         logger.error(
             f"Job {reference_number} failed with error: {pip_job_registry[reference_number].get('error', 'Unknown error')}")
@@ -358,46 +385,17 @@ def run_pipeline_queue():
             time.sleep(2)
 
 
-def get_remote_endpoints():
-    raw = os.getenv("REMOTE_PIPELINE2_WS_ENDPOINTS", "")
-    return [e.strip() for e in raw.replace(",", " ").split() if e.strip()]
-
-
 @app.get("/health", tags=["Health"])
-async def health_check():
-    internal_status = "ok"  # assume internal is always healthy here
-    alive = []
-    unavailable = []
-
-    endpoints = get_remote_endpoints()
-
-    async with httpx.AsyncClient(timeout=5.0) as client:
-        for endpoint in endpoints:
-            alive_url = endpoint.rstrip("/") + "/alive"
-            try:
-                resp = await client.get(alive_url)
-                resp.raise_for_status()
-                root = ET.fromstring(resp.text)
-                version = root.attrib.get("version", "unknown")
-                alive.append({
-                    "endpoint": endpoint,
-                    "version": version
-                })
-            except Exception as e:
-                unavailable.append({
-                    "endpoint": endpoint,
-                    "error": str(e)
-                })
+async def health_check(refresh: bool = False):
+    if refresh:
+        await asyncio.to_thread(engine_monitor.check_all)
 
     return JSONResponse(
         status_code=200,
         content={
             "status": "ok",  # reflects internal health only
-            "internal": internal_status,
-            "external": {
-                "alive": alive,
-                "unavailable": unavailable
-            }
+            "internal": "ok",  # assume internal is always healthy here
+            "external": engine_monitor.report()
         }
     )
 
@@ -415,15 +413,15 @@ async def submit_pipeline_job(
     logger.addHandler(log_handler)
     logger.info("New job submission request received.")
     temp_dir = tempfile.mkdtemp()
-    epub_path = os.path.join(temp_dir, epub.filename)
+    production_number = safe_name(os.path.splitext(os.path.basename(epub.filename or ""))[0])
+    epub_path = os.path.join(temp_dir, production_number + ".epub")
     with open(epub_path, "wb") as f:
         f.write(await epub.read())
     logger.info(f"Uploaded file saved: {epub.filename}")
 
     logger.info(
         f"Job added to queue: {epub.filename} from source: {source} (position)")
-    production_number = os.path.splitext(epub.filename)[0]
-    reference_number = f"{production_number}_{source}_{uuid.uuid4().hex[:6]}"
+    reference_number = generate_reference_number(production_number, source)
 
     def threaded_validation():
         run_validation(epub_path, reference_number,
@@ -509,3 +507,4 @@ def get_job_log(job_id: str):
 
 
 threading.Thread(target=run_pipeline_queue, daemon=True).start()
+threading.Thread(target=engine_monitor.run_monitor, daemon=True).start()
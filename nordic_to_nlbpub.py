@@ -3,12 +3,14 @@ import sys
 import subprocess
 import traceback
 import tempfile
-from pathlib import Path
+import zipfile
+from concurrent.futures import CancelledError
 import logging
 from epub import Epub
-from bs4 import BeautifulSoup
+from lxml import etree as ElementTree
 
 from filesystem import Filesystem
+from migrator_pool import migrator_pool
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,48 +23,87 @@ logger = logging.getLogger(__name__)
 def get_nordic_guidelines_version(epub_file):
     """
     Get the nordic guidelines version:  2015 or 2020 guidelines.
-    """
 
-    epub = Epub(logger, epub_file)
-    epub_unzipped = epub.asDir()
-    opf_path = Path(os.path.join(epub_unzipped, "EPUB", "package.opf"))
+    Only META-INF/container.xml and the package document are read, directly from the zip
+    (or from the directory, if the EPUB is unzipped), and the package document is only
+    parsed until the end of its metadata.
+    """
     try:
-
-        if not opf_path.exists():
-            logger.error(f"Error: OPF file not found at {opf_path}")
-            return False
-        xml_content = opf_path.read_text(encoding='utf-8')
-        soup = BeautifulSoup(xml_content, 'xml')  # Use 'xml' parser
-
-        # Extract content with property 'nordic:guidelines'
-        meta_property = soup.find("meta", property="nordic:guidelines")
-        meta_property_content = meta_property.text if meta_property else None
-        logger.info(
-            f"Content of meta with property 'nordic:guidelines':, {meta_property_content}")
-
-        # Extract single content with name 'nordic:guidelines'
-        meta_name = soup.find("meta", attrs={"name": "nordic:guidelines"})
-        meta_name_content = meta_name['content'] if meta_name and "content" in meta_name.attrs else None
-        logger.info(
-            f"Content of meta with name 'nordic:guidelines':, {meta_name_content}")
-
-    except Exception as e:
-        logger.error(f"Error reading {opf_path}: {e}")
+        if os.path.isdir(epub_file):
+            guidelines = read_nordic_guidelines(
+                lambda name: open(os.path.join(epub_file, name), "rb"))
+        else:
+            with zipfile.ZipFile(epub_file, "r") as archive:
+                guidelines = read_nordic_guidelines(archive.open)
+    except (OSError, KeyError, zipfile.BadZipFile, ElementTree.XMLSyntaxError) as e:
+        logger.error(f"Error reading the package document of {epub_file}: {e}")
+        return False
+    if guidelines is None:
+        logger.error(
+            f"Error: no package document referenced from META-INF/container.xml in {epub_file}")
         return False
+
+    meta_property_content, meta_name_content = guidelines
+    logger.info(
+        f"Content of meta with property 'nordic:guidelines':, {meta_property_content}")
+    logger.info(
+        f"Content of meta with name 'nordic:guidelines':, {meta_name_content}")
+
     if (meta_property_content is not None and meta_property_content == "2020-1") or (meta_name_content is not None and meta_name_content == "2020-1"):
         return "2020-1"
     return "2015-1"
 
 
-def nordic_to_nlbpub_with_migrator(epub_file):
+def read_nordic_guidelines(open_entry):
+    """
+    Returns the content of the first <meta property="nordic:guidelines"> and the first
+    <meta name="nordic:guidelines"> in the package document, as a tuple (None if missing),
+    or None if container.xml doesn't reference a package document.
+    `open_entry` opens a file in the EPUB by its path relative to the root of the EPUB.
+    """
+    with open_entry("META-INF/container.xml") as f:
+        container = ElementTree.parse(f).getroot()
+    rootfiles = container.findall(
+        "{urn:oasis:names:tc:opendocument:xmlns:container}rootfiles/{urn:oasis:names:tc:opendocument:xmlns:container}rootfile")
+    opf_paths = [rootfile.get("full-path") for rootfile in rootfiles
+                 if rootfile.get("media-type", "application/oebps-package+xml") == "application/oebps-package+xml"
+                 and rootfile.get("full-path")]
+    if not opf_paths:
+        return None
+
+    meta_property_content = None
+    meta_name_content = None
+    with open_entry(opf_paths[0]) as f:
+        for _, element in ElementTree.iterparse(f, events=("end",)):
+            if not isinstance(element.tag, str):
+                continue
+            local_name = ElementTree.QName(element).localname
+            if local_name == "meta":
+                if meta_property_content is None and element.get("property") == "nordic:guidelines":
+                    meta_property_content = (element.text or "").strip()
+                if meta_name_content is None and element.get("name") == "nordic:guidelines":
+                    meta_name_content = element.get("content")
+                if meta_property_content is not None and meta_name_content is not None:
+                    break
+            elif local_name == "metadata":
+                # the meta elements are all in the metadata, so there's no need to read the manifest and spine
+                break
+    return meta_property_content, meta_name_content
+
+
+def nordic_to_nlbpub_with_migrator(epub_file, reference=None, log=None, epub=None):
     """
     Convert Nordic EPUB to NLBPUB format.
+
+    The migrator runs in the shared migrator pool, so several books can be converted at the
+    same time. Its output is logged to `log` (the log of the job) while it runs, and the run
+    can be cancelled with migrator_pool.cancel(reference). `epub` can be an already unpacked
+    Epub of `epub_file` (see JobArtifacts).
     """
+    log = log or logger
     success = False
-    epub = Epub(logger, epub_file)
+    epub = epub or Epub(logger, epub_file)
     epub_unzipped = epub.asDir()
-    temp_xml_file_obj = tempfile.NamedTemporaryFile()
-    temp_xml_file = temp_xml_file_obj.name
     html_dir_obj = tempfile.TemporaryDirectory()
     html_dir = html_dir_obj.name
     try:
@@ -75,19 +116,25 @@ def nordic_to_nlbpub_with_migrator(epub_file):
                 "EPUB_TO_HTML_HOME is not set. Using default value: /opt/nordic-epub3-dtbook-migrator")
             epub_to_html_home = "/opt/nordic-epub3-dtbook-migrator"
 
-        process = Filesystem.run_static(command, epub_to_html_home, logger)
-        success = process.returncode == 0
+        run = migrator_pool.submit(
+            reference or epub.identifier(), command, epub_to_html_home, log)
+        success = run.result()
+        if run.cancelled.is_set():
+            log.info("Konverteringen ble avbrutt")
+        elif not success and not run.timed_out:
+            log.error("Migratoren feilet med returkode {}:\n{}".format(
+                run.returncode, "\n".join(run.tail)))
 
-    except subprocess.TimeoutExpired:
-        logger.error("Converting took too long and were therefore stopped.")
+    except CancelledError:
+        log.info("Konverteringen ble avbrutt før den startet")
 
     except Exception:
-        logger.debug(traceback.format_exc(), preformatted=True)
-        logger.report.error(
+        log.debug(traceback.format_exc())
+        log.error(
             "An error occured while running EPUB to HTML")
 
     if not success:
-        logger.error("Klarte ikke å konvertere boken")
+        log.error("Klarte ikke å konvertere boken")
         return False
 
     logger.debug(
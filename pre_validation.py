@@ -0,0 +1,220 @@
+import os
+import sys
+import logging
+import zlib
+import posixpath
+import zipfile
+
+from lxml import etree as ElementTree
+
+from epub import Epub
+from filesystem import Filesystem
+from jing import Jing
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+# what reading a damaged, encrypted or oddly compressed zip entry can raise
+ZIP_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError,
+              RuntimeError, NotImplementedError, UnicodeDecodeError)
+
+
+class ValidationReport():
+    """Collects the messages reported by Epub, so that they can be returned as structured errors"""
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+
+    def error(self, message, check="epub", file=None):
+        self.errors.append({"check": check, "message": message, "file": file})
+        logger.error(message)
+
+    def warn(self, message, check="epub", file=None):
+        self.warnings.append(
+            {"check": check, "message": message, "file": file})
+        logger.warning(message)
+
+    def warning(self, message, *args, **kwargs):
+        self.warn(message, *args, **kwargs)
+
+    def info(self, message, *args, **kwargs):
+        logger.info(message)
+
+    def debug(self, message, *args, **kwargs):
+        logger.debug(message)
+
+    def result(self):
+        return {
+            "status": "error" if self.errors else "ok",
+            "errors": self.errors,
+            "warnings": self.warnings,
+        }
+
+
+def find_image_errors(image_files_present, opf_image_references, html_image_references):
+    """
+    Compares the image files in the EPUB with the images declared in the OPF and referenced from the HTML.
+    Paths are relative to the directory of the OPF. Returns a list of (message, file) tuples.
+    """
+    errors = []
+    for file in image_files_present:
+        if file not in opf_image_references:
+            errors.append(
+                ("Bildefilen er ikke deklarert i OPFen: " + file, file))
+    for file in opf_image_references:
+        if file not in image_files_present:
+            errors.append(
+                ("Bildefilen er deklarert i OPFen, men finnes ikke: " + file, file))
+    for file in html_image_references:
+        if file not in opf_image_references:
+            errors.append(("Bildefilen er deklarert i HTMLen, men finnes ikke: " + file
+                           + " (deklarert i: " + ", ".join(html_image_references[file]) + ")", file))
+    return errors
+
+
+def pre_validate_epub(epub_file, artifacts=None):
+    """
+    Fast local checks that don't need the remote Pipeline 2: the OCF container,
+    the mimetype, well-formedness of the package and content documents, and
+    consistency between the image files, the OPF manifest and the HTML.
+
+    The EPUB is read directly from the zip; nothing is extracted to disk, except for
+    the schema validation, which uses the unpacked EPUB from `artifacts` when given.
+    """
+    report = ValidationReport()
+    epub = Epub(report, epub_file)
+
+    if not os.path.isfile(epub_file):
+        report.error("Epub {} finnes ikke.".format(os.path.basename(epub_file)), check="file")
+        return report.result()
+
+    try:
+        if not epub.isepub():
+            # Epub.isepub reports the reason as a warning, but for us it is fatal
+            report.errors.extend(report.warnings)
+            report.warnings = []
+            return report.result()
+
+        with zipfile.ZipFile(epub_file, "r") as archive:
+            validate_archive(report, archive)
+    except ZIP_ERRORS as e:
+        report.error("Ugyldig ZIP-fil: {}".format(e), check="zip")
+        return report.result()
+
+    # schema validation is slower, so only run it when the quick checks pass and schemas are configured
+    if not report.errors and any(Jing.schemas.values()):
+        # problems with Jing itself are not the fault of the book, so they are only warnings
+        jing_report = ValidationReport()
+        if artifacts:
+            with artifacts.use() as shared_epub:
+                results = Jing.validate_epub(jing_report, epub_file, epub=shared_epub)
+        else:
+            results = Jing.validate_epub(jing_report, epub_file)
+        for result in results or []:
+            for error in result["errors"]:
+                message = "{}:{}:{}: {}".format(
+                    result["document"], error["line"], error["column"], error["message"])
+                if error["severity"] == "warning":
+                    report.warn(message, check="schema", file=result["document"])
+                else:
+                    report.error(message, check="schema", file=result["document"])
+        for message in jing_report.errors + jing_report.warnings:
+            report.warn(message["message"], check="schema", file=message["file"])
+
+    return report.result()
+
+
+def validate_archive(report, archive):
+    infolist = archive.infolist()
+    names = set(info.filename for info in infolist)
+
+    problems = Filesystem.check_zip_limits(infolist)
+    for problem in problems:
+        report.error(problem, check="zip")
+    if problems:
+        return
+
+    if infolist[0].filename != "mimetype":
+        report.warn("The 'mimetype' file is not the first file in the ZIP",
+                    check="mimetype", file="mimetype")
+    elif infolist[0].compress_type != zipfile.ZIP_STORED:
+        report.warn("The 'mimetype' file is compressed",
+                    check="mimetype", file="mimetype")
+
+    try:
+        container = ElementTree.XML(archive.read("META-INF/container.xml"))
+        rootfile = container.find(
+            '{urn:oasis:names:tc:opendocument:xmlns:container}rootfiles/{urn:oasis:names:tc:opendocument:xmlns:container}rootfile')
+        opf_path = rootfile.attrib["full-path"] if rootfile is not None else None
+    except (ElementTree.XMLSyntaxError, KeyError) as e:
+        report.error("META-INF/container.xml er ugyldig: {}".format(e),
+                     check="container", file="META-INF/container.xml")
+        return
+
+    if not opf_path:
+        report.error("META-INF/container.xml refererer ikke til noen OPF",
+                     check="container", file="META-INF/container.xml")
+        return
+
+    if opf_path != "EPUB/package.opf":
+        report.error("Pakkedokumentet må ligge i EPUB/package.opf, men container.xml refererer til " + opf_path,
+                     check="container", file="META-INF/container.xml")
+    if opf_path not in names:
+        report.error(opf_path + " eksisterer ikke. Kan ikke validere EPUB.",
+                     check="opf", file=opf_path)
+        return
+
+    try:
+        opf = ElementTree.XML(archive.read(opf_path))
+    except ElementTree.XMLSyntaxError as e:
+        report.error("OPFen er ikke velformet: {}".format(e),
+                     check="well-formedness", file=opf_path)
+        return
+
+    opf_dir = posixpath.dirname(opf_path)
+
+    def relative(path):
+        return posixpath.relpath(path, opf_dir) if opf_dir else path
+
+    if not opf.xpath("/*/*[local-name()='metadata']/*[local-name()='identifier']/text()"):
+        report.error("Mangler dc:identifier – kan ikke finne boknummer",
+                     check="metadata", file=opf_path)
+
+    opf_image_references = []
+    content_documents = []
+    for item in opf.xpath("/*/*[local-name()='manifest']/*[local-name()='item']"):
+        href = item.attrib.get("href", "")
+        full_path = posixpath.normpath(posixpath.join(opf_dir, href))
+        if item.attrib.get("media-type", "").startswith("image/"):
+            opf_image_references.append(href)
+        elif full_path not in names:
+            report.error("Filen er deklarert i OPFen, men finnes ikke: " + href,
+                         check="manifest", file=href)
+        elif item.attrib.get("media-type") == "application/xhtml+xml":
+            content_documents.append(full_path)
+
+    html_image_references = {}
+    for content_document in content_documents:
+        try:
+            html = ElementTree.XML(archive.read(content_document))
+        except ElementTree.XMLSyntaxError as e:
+            report.error("Innholdsdokumentet er ikke velformet: {}".format(e),
+                         check="well-formedness", file=content_document)
+            continue
+        filename = posixpath.basename(content_document)
+        for reference in html.xpath("//@href | //@src | //@altimg"):
+            path = reference.split("#")[0]
+            if path.startswith("images/"):
+                html_image_references.setdefault(path, []).append(filename)
+
+    images_dir = posixpath.join(opf_dir, "images") + "/"
+    image_files_present = [relative(name) for name in names
+                           if name.startswith(images_dir) and not name.endswith("/")]
+
+    for message, file in find_image_errors(image_files_present, opf_image_references, html_image_references):
+        report.error(message, check="images", file=file)
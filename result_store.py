@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from datetime import datetime
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+RESULT_STORE_ROOT = os.environ.get("RESULT_STORE_ROOT") or os.path.join(
+    tempfile.gettempdir(), "nordic_to_bok_results")
+RESULT_STORE_TTL = int(os.environ.get("RESULT_STORE_TTL", str(7 * 24 * 3600)))
+RESULT_STORE_MAX_SIZE = int(os.environ.get(
+    "RESULT_STORE_MAX_SIZE", str(50 * 1024 * 1024 * 1024)))
+
+
+class ResultStore:
+    """
+    Final result zips, addressed by reference number.
+
+    Results are removed when they are older than the TTL, and the least recently
+    downloaded results are removed when the store grows beyond its max size.
+    The index is written to disk on every change, so results survive a restart. Access
+    times are only kept in memory, and written with the next change or by the evictor.
+    """
+
+    index_filename = "index.json"
+
+    def __init__(self, root=RESULT_STORE_ROOT, ttl=RESULT_STORE_TTL, max_size=RESULT_STORE_MAX_SIZE):
+        self.root = root
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self.index = self._load_index()
+        # True when the index has access times that are not on disk yet
+        self.dirty = False
+        # called with the reference of every result that is removed from the store
+        self.removal_listeners = []
+
+    def _index_path(self):
+        return os.path.join(self.root, ResultStore.index_filename)
+
+    def _load_index(self):
+        index = {}
+        try:
+            with open(self._index_path(), encoding="utf-8") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read the result index, starting with an empty index: {e}")
+
+        # drop entries where the file is gone, and files that are not in the index
+        index = {reference: entry for reference, entry in index.items()
+                 if os.path.isfile(os.path.join(self.root, entry["filename"]))}
+        known = set(entry["filename"] for entry in index.values())
+        for filename in os.listdir(self.root):
+            if filename != ResultStore.index_filename and filename not in known:
+                path = os.path.join(self.root, filename)
+                if os.path.isfile(path):
+                    os.remove(path)
+        return index
+
+    def add_removal_listener(self, callback):
+        self.removal_listeners.append(callback)
+
+    def _removed(self, references):
+        for reference in references:
+            for callback in self.removal_listeners:
+                try:
+                    callback(reference)
+                except Exception:
+                    logger.exception(f"Removal listener failed for {reference}")
+
+    def _save_index(self):
+        temp_path = self._index_path() + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(temp_path, self._index_path())
+        self.dirty = False
+
+    def put(self, reference, zip_path, status):
+        """Move `zip_path` into the store as the result for `reference`."""
+        filename = reference + ".zip"
+        target = os.path.join(self.root, filename)
+        temp_target = target + ".tmp"
+        shutil.move(zip_path, temp_target)
+        os.replace(temp_target, target)
+
+        now = time.time()
+        with self.lock:
+            self.index[reference] = {
+                "filename": filename,
+                "status": status,
+                "size": os.path.getsize(target),
+                "created": now,
+                "last_access": now,
+                "stored": datetime.utcnow().isoformat(),
+            }
+            removed = self._evict()
+            self._save_index()
+        self._removed(removed)
+        return target
+
+    def get(self, reference):
+        """Path of the result for `reference`, or None. Counts as an access for the LRU eviction."""
+        with self.lock:
+            entry = self.index.get(reference)
+            if not entry:
+                return None
+            path = os.path.join(self.root, entry["filename"])
+            if os.path.isfile(path):
+                entry["last_access"] = time.time()
+                self.dirty = True
+                return path
+            del self.index[reference]
+            self._save_index()
+        self._removed([reference])
+        return None
+
+    def entry(self, reference):
+        with self.lock:
+            entry = self.index.get(reference)
+            return dict(entry) if entry else None
+
+    def total_size(self):
+        with self.lock:
+            return sum(entry["size"] for entry in self.index.values())
+
+    def evict(self):
+        with self.lock:
+            removed = self._evict()
+            if removed or self.dirty:
+                self._save_index()
+        self._removed(removed)
+        return removed
+
+    def _evict(self):
+        now = time.time()
+        removed = [reference for reference, entry in self.index.items()
+                   if now - entry["created"] > self.ttl]
+
+        total = sum(entry["size"] for reference, entry in self.index.items()
+                    if reference not in removed)
+        if total > self.max_size:
+            by_access = sorted((entry["last_access"], reference) for reference, entry in self.index.items()
+                               if reference not in removed)
+            for _, reference in by_access:
+                if total <= self.max_size:
+                    break
+                total -= self.index[reference]["size"]
+                removed.append(reference)
+
+        for reference in removed:
+            entry = self.index.pop(reference)
+            logger.info(f"Evicting result for {reference}")
+            try:
+                os.remove(os.path.join(self.root, entry["filename"]))
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def run_evictor(self, interval=300):
+        while True:
+            try:
+                self.evict()
+            except Exception:
+                logger.exception("Evicting results failed")
+            time.sleep(interval)
+
+
+result_store = ResultStore()
@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import math
+import time
+import bisect
+import logging
+import threading
+from collections import OrderedDict, deque
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+# the configuration of each source, as JSON: {"source": {"weight": 2, "max_running": 1, "rate_per_minute": 10}}
+SCHEDULER_SOURCES = json.loads(os.environ.get("SCHEDULER_SOURCES") or "{}")
+SCHEDULER_DEFAULT_WEIGHT = int(os.environ.get("SCHEDULER_DEFAULT_WEIGHT", "1"))
+SCHEDULER_DEFAULT_MAX_RUNNING = int(
+    os.environ.get("SCHEDULER_DEFAULT_MAX_RUNNING", "0"))
+SCHEDULER_DEFAULT_RATE_PER_MINUTE = float(
+    os.environ.get("SCHEDULER_DEFAULT_RATE_PER_MINUTE", "0"))
+
+
+class SourceConfig:
+    """
+    How a source is scheduled. `weight` is its share relative to the other sources,
+    `max_running` caps how many of its jobs run at the same time, and `rate_per_minute`
+    caps how many of its jobs are started per minute. 0 means no limit.
+    """
+
+    def __init__(self, weight=SCHEDULER_DEFAULT_WEIGHT, max_running=SCHEDULER_DEFAULT_MAX_RUNNING,
+                 rate_per_minute=SCHEDULER_DEFAULT_RATE_PER_MINUTE):
+        if weight < 1:
+            raise ValueError("weight must be at least 1")
+        if max_running < 0 or rate_per_minute < 0:
+            raise ValueError("max_running and rate_per_minute can't be negative")
+        self.weight = weight
+        self.max_running = max_running
+        self.rate_per_minute = rate_per_minute
+
+    def as_dict(self):
+        return {"weight": self.weight, "max_running": self.max_running, "rate_per_minute": self.rate_per_minute}
+
+
+class SourceState:
+    def __init__(self, config):
+        self.config = config
+        self.queue = deque()
+        # the number of jobs in the queue that haven't been removed
+        self.queued = 0
+        self.running = 0
+        self.current_weight = 0
+        # token bucket for the rate limit, with room for a burst of one minute
+        self.tokens = config.rate_per_minute
+        self.tokens_updated = time.monotonic()
+        # every job gets the next ticket when it is queued. Removed jobs stay in the queue until they
+        # reach the head (lazy deletion), and their tickets are kept sorted until then
+        self.next_ticket = 0
+        self.removed = []
+
+    def refill(self, now):
+        rate = self.config.rate_per_minute
+        if rate:
+            self.tokens = min(rate, self.tokens + (now - self.tokens_updated) * rate / 60)
+        self.tokens_updated = now
+
+    def eligible(self, now):
+        if not self.queued:
+            return False
+        if self.config.max_running and self.running >= self.config.max_running:
+            return False
+        if self.config.rate_per_minute:
+            self.refill(now)
+            if self.tokens < 1:
+                return False
+        return True
+
+
+class FairShareQueue:
+    """
+    The job queue, with one FIFO queue per source. Sources take turns by smooth weighted
+    round robin, so a source that submits many jobs at once gets its share, but does not
+    starve the others. Sources over their concurrency cap or rate limit are skipped until
+    they are below it again.
+
+    It has the list operations that the rest of the app uses on the job queue: append,
+    remove, len and iteration (in the order the jobs were submitted per source). Workers
+    take jobs with pop() and must call done() when a job has finished. Queued jobs can be
+    looked up by reference number with get(), and position() tells where a job is in the queue.
+    """
+
+    def __init__(self, sources=SCHEDULER_SOURCES):
+        self.configs = {source: SourceConfig(**config) for source, config in sources.items()}
+        self.sources = OrderedDict()
+        # reference number -> (source, ticket, job) of the queued jobs
+        self.tickets = {}
+        self.lock = threading.Lock()
+
+    def _state(self, source):
+        state = self.sources.get(source)
+        if state is None:
+            state = SourceState(self.configs.get(source) or SourceConfig())
+            self.sources[source] = state
+        return state
+
+    def configure(self, source, **config):
+        """Change the configuration of a source at runtime."""
+        with self.lock:
+            previous = self.configs.get(source) or SourceConfig()
+            config = SourceConfig(**dict(previous.as_dict(), **config))
+            self.configs[source] = config
+            if source in self.sources:
+                self.sources[source].config = config
+                self.sources[source].tokens = min(self.sources[source].tokens, config.rate_per_minute)
+        logger.info(f"Scheduling of source {source}: {config.as_dict()}")
+        return config
+
+    def _ticket(self, job):
+        return self.tickets[job["reference_number"]][1]
+
+    def _forget_if_idle(self, source, state):
+        # a rate limited source keeps its state, so that its token bucket isn't reset
+        if not state.queued and not state.running and not state.config.rate_per_minute:
+            del self.sources[source]
+
+    def _passed(self, state):
+        """Drop removed jobs from the head of the queue, and forget the removed tickets the head has passed."""
+        while state.queue and state.queue[0]["reference_number"] not in self.tickets:
+            state.queue.popleft()
+        if not state.queue:
+            state.removed.clear()
+        elif state.removed:
+            del state.removed[:bisect.bisect_left(state.removed, self._ticket(state.queue[0]))]
+
+    def append(self, job):
+        with self.lock:
+            state = self._state(job["source"])
+            self.tickets[job["reference_number"]] = (job["source"], state.next_ticket, job)
+            state.next_ticket += 1
+            state.queue.append(job)
+            state.queued += 1
+
+    def remove(self, job):
+        with self.lock:
+            state = self.sources[job["source"]]
+            _, ticket, _ = self.tickets.pop(job["reference_number"])
+            state.queued -= 1
+            bisect.insort(state.removed, ticket)
+            self._passed(state)
+            self._forget_if_idle(job["source"], state)
+
+    def get(self, reference):
+        """The queued job with this reference number, or None."""
+        with self.lock:
+            entry = self.tickets.get(reference)
+        return entry[2] if entry else None
+
+    def position(self, reference):
+        """
+        Where a queued job is, or None if it isn't queued. `source_position` is its place among
+        the jobs of its own source (1 is next), and `position` estimates its place in the whole
+        queue, from how many jobs the other sources get to start while its source catches up.
+        """
+        with self.lock:
+            entry = self.tickets.get(reference)
+            if entry is None:
+                return None
+            source, ticket, _ = entry
+            state = self.sources[source]
+            head = self._ticket(state.queue[0])
+            removed_between = bisect.bisect_left(state.removed, ticket) - bisect.bisect_left(state.removed, head)
+            ahead = ticket - head - removed_between
+            # while the source starts `ahead` jobs, the others start jobs in proportion to their weight;
+            # ties go to the source that was seen first
+            others = 0
+            before = True
+            for other in self.sources.values():
+                if other is state:
+                    before = False
+                    continue
+                turns = ahead + 1 if before else ahead
+                others += min(other.queued, math.ceil(turns * other.config.weight / state.config.weight))
+            return {"source_position": ahead + 1, "position": ahead + others + 1}
+
+    def pop(self):
+        """The next job to run, or None if no source may start a job right now."""
+        now = time.monotonic()
+        with self.lock:
+            eligible = [state for state in self.sources.values() if state.eligible(now)]
+            if not eligible:
+                return None
+            total = sum(state.config.weight for state in eligible)
+            for state in eligible:
+                state.current_weight += state.config.weight
+            chosen = max(eligible, key=lambda state: state.current_weight)
+            chosen.current_weight -= total
+            chosen.running += 1
+            if chosen.config.rate_per_minute:
+                chosen.tokens -= 1
+            job = chosen.queue.popleft()
+            chosen.queued -= 1
+            del self.tickets[job["reference_number"]]
+            self._passed(chosen)
+            return job
+
+    def done(self, job):
+        with self.lock:
+            state = self.sources.get(job["source"])
+            if state:
+                state.running = max(0, state.running - 1)
+                self._forget_if_idle(job["source"], state)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.tickets)
+
+    def __iter__(self):
+        with self.lock:
+            jobs = [job for state in self.sources.values() for job in state.queue
+                    if job["reference_number"] in self.tickets]
+        return iter(jobs)
+
+    def status(self):
+        with self.lock:
+            sources = {source: dict(state.config.as_dict(), queued=state.queued, running=state.running)
+                       for source, state in self.sources.items()}
+            configured = {source: config.as_dict() for source, config in self.configs.items()}
+        return {
+            "sources": sources,
+            "configured": configured,
+            "default": SourceConfig().as_dict(),
+        }
@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Trace:
+    """
+    The timeline of one job: a list of named spans with start and end times.
+
+    Spans can be nested, and can be recorded from any thread. The trace can be exported
+    in the Chrome trace-event format, which can be opened in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self, reference=None):
+        self.reference = reference
+        self.spans = []
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def start(self, name, category="job", **args):
+        """Start a span and return it. The span must be ended with finish()."""
+        thread = threading.current_thread()
+        span = {
+            "name": name,
+            "category": category,
+            "start": time.time(),
+            "end": None,
+            "thread": thread.ident,
+            "args": args,
+        }
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            self.spans.append(span)
+        return span
+
+    def finish(self, span, **args):
+        with self.lock:
+            span["args"].update(args)
+            if span["end"] is None:
+                span["end"] = time.time()
+        return span
+
+    def add(self, name, start, end, category="job", **args):
+        """Record a span that has already happened, for instance the time spent in the queue."""
+        span = self.start(name, category, **args)
+        with self.lock:
+            span["start"] = start
+            span["end"] = end
+        return span
+
+    @contextmanager
+    def span(self, name, category="job", **args):
+        span = self.start(name, category, **args)
+        try:
+            yield span
+        except BaseException as e:
+            self.finish(span, error=type(e).__name__)
+            raise
+        else:
+            self.finish(span)
+
+    def close(self):
+        """End the spans that are still open, for instance after an early return."""
+        now = time.time()
+        with self.lock:
+            for span in self.spans:
+                if span["end"] is None:
+                    span["end"] = now
+                    span["args"]["unfinished"] = True
+
+    def to_chrome(self):
+        """The trace as a Chrome trace-event JSON object, with one row per thread."""
+        pid = os.getpid()
+        with self.lock:
+            spans = [dict(span, args=dict(span["args"])) for span in self.spans]
+            threads = dict(self.threads)
+
+        now = time.time()
+        events = [{
+            "name": "thread_name",
+            "ph": "M",
+            "pid": pid,
+            "tid": ident,
+            "args": {"name": name},
+        } for ident, name in threads.items()]
+        for span in spans:
+            end = span["end"]
+            if end is None:
+                end = now
+                span["args"]["running"] = True
+            events.append({
+                "name": span["name"],
+                "cat": span["category"],
+                "ph": "X",
+                "ts": int(span["start"] * 1000000),
+                "dur": int(max(end - span["start"], 0) * 1000000),
+                "pid": pid,
+                "tid": span["thread"],
+                "args": span["args"],
+            })
+
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"reference": self.reference},
+        }
@@ -1,4 +1,5 @@
 import os
+import re
 import subprocess
 import logging
 import sys
@@ -19,9 +20,14 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def safe_name(value: Optional[str], default: str = "unknown") -> str:
+    """Client input made safe for file names and URLs: anything but letters, digits, _ and - becomes _."""
+    return re.sub(r"[^A-Za-z0-9_-]", "_", value or "") or default
+
+
 def generate_reference_number(production_number: str, source: str) -> str:
 
-    reference_number = f"{production_number}_{source}_{uuid.uuid4().hex[:6]}"
+    reference_number = f"{safe_name(production_number)}_{safe_name(source)}_{uuid.uuid4().hex[:6]}"
     return reference_number
 
 
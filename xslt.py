@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import os
+import shutil
 import subprocess
+import tempfile
 import traceback
 
 
@@ -65,7 +67,7 @@ class Xslt():
                 command.append(param + "=" + parameters[param])
 
             report.debug("Running XSLT")
-            process = Filesystem.run_static(
+            process = Filesystem.run_static_streaming(
                 command, cwd, report, stdout_level=stdout_level, stderr_level=stderr_level)
             self.success = process.returncode == 0
 
@@ -77,3 +79,56 @@ class Xslt():
             report.debug(traceback.format_exc(), preformatted=True)
             report.error(
                 "An error occured while running the XSLT (" + str(stylesheet) + ")")
+
+    @staticmethod
+    def transform_batch(report, stylesheet, sources, parameters={}, cwd=None):
+        """
+        Transform several documents with the same stylesheet in one Saxon run (one JVM),
+        and replace the sources with the results.
+
+        Saxon transforms every file in a directory when given a directory as source,
+        so the sources are symlinked into a temporary directory. The results are
+        staged next to the sources and moved in place with os.replace only when
+        all documents were transformed successfully.
+        """
+        input_dir = tempfile.mkdtemp()
+        output_dir = tempfile.mkdtemp()
+        staged = []
+        try:
+            names = {}
+            for i, source in enumerate(sources):
+                name = "{:05d}-{}".format(i, os.path.basename(source))
+                os.symlink(os.path.abspath(source),
+                           os.path.join(input_dir, name))
+                names[source] = name
+
+            xslt = Xslt(report=report,
+                        stylesheet=stylesheet,
+                        source=input_dir,
+                        target=output_dir,
+                        parameters=parameters,
+                        cwd=cwd)
+            if not xslt.success:
+                return False
+
+            for source, name in names.items():
+                result = os.path.join(output_dir, name)
+                if not os.path.isfile(result):
+                    report.error(
+                        "XSLTen {} produserte ikke noe resultat for {}".format(stylesheet, source))
+                    return False
+                staged_path = source + ".xslt-tmp"
+                shutil.copy(result, staged_path)
+                staged.append((staged_path, source))
+
+            for staged_path, source in staged:
+                os.replace(staged_path, source)
+            staged = []
+            return True
+
+        finally:
+            for staged_path, _ in staged:
+                if os.path.exists(staged_path):
+                    os.remove(staged_path)
+            shutil.rmtree(input_dir, ignore_errors=True)
+            shutil.rmtree(output_dir, ignore_errors=True)